@@ -2,6 +2,8 @@
 
 # IMPORT LIBRARIES
 import streamlit as st
+from XAI_APP_utils import start_warm_up, show_warm_up_status, get_openai_client
+from XAI_APP_pipeline import DIVERGENT_ROLE_DESCRIPTION, CONVERGENT_ROLE_DESCRIPTION
 
 # DEFINE THE PAGES THAT THE GUI WILL HAVE
 st.set_page_config(
@@ -9,6 +11,10 @@ st.set_page_config(
     layout="wide" # Set wide layout for the entire app
 )
 
+# Prepare the slow models in the background as soon as the server receives its first visit
+start_warm_up()
+show_warm_up_status()
+
 #DEFINE THE SIDEBAR INFORMATION
 
 st.sidebar.success("Select the stage of the design process you want to work on.")
@@ -25,8 +31,7 @@ if openai_key:
 # 4. Initialize APIs if the key is provided in session state
 if st.session_state.openai_key:
     try:
-        from openai import OpenAI
-        st.session_state.client = OpenAI(api_key=st.session_state.openai_key)  # Store client in session_state to be able to access it from other pages
+        st.session_state.client = get_openai_client(st.session_state.openai_key)  # Store the shared client in session_state to be able to access it from other pages
         st.success("API initialized successfully!")
     except Exception as e:
         st.error(f"Failed to initialize API: {e}")
@@ -67,9 +72,9 @@ st.markdown("""
 if "client" in st.session_state:
     # Store role descriptions in session state
     if "role_description_divergent" not in st.session_state:
-        st.session_state.role_description_divergent = "You are an experienced designer that is able to propose numerous innovative design proposals for FBS ontology design problems."
+        st.session_state.role_description_divergent = DIVERGENT_ROLE_DESCRIPTION
     if "role_description_convergent" not in st.session_state:
-        st.session_state.role_description_convergent = "You are a design expert able to classify design proposals as bad, poor, regular, good or excellent."
+        st.session_state.role_description_convergent = CONVERGENT_ROLE_DESCRIPTION
     # Get the design problem description and store it in session state only once, to avoid its value being modified if the user comes back to this page
     if "design_problem" not in st.session_state:
         # Ask for input only if not set
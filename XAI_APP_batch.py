@@ -0,0 +1,286 @@
+# BATCH RUNS OF THE DESIGN PROCESS
+# This script runs the headless design pipeline (see XAI_APP_pipeline.py) for many design problems: FBS generation, embeddings, clustering and optionally the feature importance of every solution
+# The design problems are read from a JSONL or CSV file with a design_problem column (or the "Design Goal" of the Divergent Thinking JSON files) and optional id and requirements columns (requirements separated by ";" in CSV files)
+# The results are written to a JSONL file or a Parquet directory as soon as each problem finishes (pyarrow is needed for Parquet), the problems already in the output are skipped so an interrupted run is resumed by running the same command again
+# Usage: python XAI_APP_batch.py problems.jsonl results.jsonl [--explain] [--workers 4] [--format jsonl|parquet] (the OpenAI API key is read from OPENAI_API_KEY or --api-key)
+
+# IMPORT LIBRARIES
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from XAI_APP_utils import PipelineCallbacks, get_openai_client, estimate_openai_cost, CONVERGENCE_POLICIES
+from XAI_APP_pipeline import DesignPipeline, PipelineConfig, DEFAULT_REQUIREMENTS, FBS_ELEMENTS, fbs_category
+
+# FBS categories of the results, in the order of the FBS elements
+CATEGORIES = [fbs_category(key) for key in FBS_ELEMENTS]
+
+
+# READ THE DESIGN PROBLEMS
+
+# This function returns the requirements of a design problem as a list, all the default requirements are used if none are given
+def parse_requirements(value):
+    if isinstance(value, str):
+        value = value.split(";")
+    requirements = [requirement.strip() for requirement in value or [] if isinstance(requirement, str) and requirement.strip()]
+    return requirements or list(DEFAULT_REQUIREMENTS)
+
+# This function returns the id of a design problem, the given one or a hash of its content so the same problem keeps its id between runs
+def problem_id(design_problem, requirements):
+    return hashlib.sha256(json.dumps([design_problem, requirements]).encode("utf-8")).hexdigest()[:16]
+
+# This function reads the design problems of a JSONL or CSV file, the repeated problems are only kept once
+def read_problems(path):
+    with open(path, "r", encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+
+    problems = {}
+    for row in rows:
+        design_problem = (row.get("design_problem") or row.get("Design Goal") or "").strip()
+        if not design_problem:
+            continue
+        requirements = parse_requirements(row.get("requirements", row.get("Requirements")))
+        row_id = str(row.get("id") or problem_id(design_problem, requirements))
+        problems.setdefault(row_id, {"id": row_id, "design_problem": design_problem, "requirements": requirements})
+    return list(problems.values())
+
+
+# WRITE THE RESULTS
+
+# This class appends each result as a line of a JSONL file, the file is flushed after every line so the finished problems are kept if the run is interrupted
+class JsonlResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.remove_partial_line()
+
+    # This function removes the last line of the file if the previous run was interrupted while writing it
+    def remove_partial_line(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as file:
+            content = file.read()
+            if content and not content.endswith(b"\n"):
+                file.truncate(content.rfind(b"\n") + 1)
+
+    # This function returns the ids of the problems already written
+    def completed_ids(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, "r", encoding="utf-8") as file:
+            return {json.loads(line)["id"] for line in file if line.strip()}
+
+    def write(self, record):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        pass
+
+# This class writes the results as Parquet files of rows_per_file results in a directory (read it with pandas.read_parquet(directory))
+# Each file is written to a temporary name and renamed once it is complete. By default every result is written to its own file as soon as it is finished, with more rows per file the pending results are only kept in memory and a crash loses them
+class ParquetResultWriter:
+    def __init__(self, path, rows_per_file=1):
+        self.path = path
+        self.rows_per_file = rows_per_file
+        self.rows = []
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    # This function returns the fixed schema of the results, so all the files of the directory can be read together
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+        fields = [("id", pa.string()), ("design_problem", pa.string()), ("requirements", pa.list_(pa.string())), ("seconds", pa.float64())]
+        for category in CATEGORIES:
+            fields += [
+                (category, pa.list_(pa.string())),
+                (f"{category}_clusters", pa.list_(pa.int64())),
+                (f"{category}_umap", pa.list_(pa.list_(pa.float64()))),
+                (f"{category}_silhouette", pa.float64()),
+                (f"{category}_ch", pa.float64()),
+                (f"{category}_requirements", pa.list_(pa.string())),
+                (f"{category}_requirement_similarities", pa.list_(pa.float64())),
+            ]
+        fields += [("explanations", pa.string()), ("errors", pa.string())]  # Nested values are stored as JSON
+        return pa.schema(fields)
+
+    def completed_ids(self):
+        import pyarrow.parquet as pq
+        ids = set()
+        for name in os.listdir(self.path):
+            if name.endswith(".parquet"):
+                ids.update(pq.read_table(os.path.join(self.path, name), columns=["id"]).column("id").to_pylist())
+        return ids
+
+    def write(self, record):
+        with self.lock:
+            self.rows.append({**record, "explanations": json.dumps(record["explanations"]), "errors": json.dumps(record["errors"])})
+            if len(self.rows) >= self.rows_per_file:
+                self.flush()
+
+    # This function writes the pending rows to a new file of the directory
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self.rows:
+            return
+        name = f"part-{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{self.rows[0]['id']}.parquet"
+        temporary_path = os.path.join(self.path, f".{name}.tmp")
+        pq.write_table(pa.Table.from_pylist(self.rows, schema=self.schema()), temporary_path)
+        os.replace(temporary_path, os.path.join(self.path, name))
+        self.rows = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+
+# This function returns the result writer of an output path, the format is deduced from its extension if it is not given
+def create_result_writer(path, format=None, rows_per_file=1):
+    format = format or ("jsonl" if path.lower().endswith(".jsonl") else "parquet")
+    if format == "jsonl":
+        return JsonlResultWriter(path)
+    if format == "parquet":
+        return ParquetResultWriter(path, rows_per_file)
+    raise ValueError(f"Unknown output format '{format}', use 'jsonl' or 'parquet'.")
+
+
+# RUN THE DESIGN PROBLEMS
+
+# This function converts the results of DesignPipeline.run into a flat record with only JSON types
+def build_record(problem, result, seconds):
+    record = {"id": problem["id"], "design_problem": problem["design_problem"], "requirements": problem["requirements"], "seconds": seconds}
+    explanations = []
+    for category in CATEGORIES:
+        results = result["categories"].get(category, {})
+        requirements = results.get("requirements")
+        record[category] = results.get("solutions", [])
+        record[f"{category}_clusters"] = results["clusters"].tolist() if "clusters" in results else None
+        record[f"{category}_umap"] = results["umap"].tolist() if "umap" in results else None
+        record[f"{category}_silhouette"] = None if results.get("silhouette") is None else float(results["silhouette"])
+        record[f"{category}_ch"] = None if results.get("ch_index") is None else float(results["ch_index"])
+        record[f"{category}_requirements"] = requirements["Most Similar Requirement"].tolist() if requirements is not None else None
+        record[f"{category}_requirement_similarities"] = requirements["Similarity"].astype(float).tolist() if requirements is not None else None
+        for option, (rating, tokens, scores, run_report, _) in results.get("explanations", {}).items():
+            explanations.append({"category": category, "option": option, "rating": rating, "tokens": tokens, "scores": [float(score) for score in scores], **run_report})
+    record["explanations"] = explanations
+    record["errors"] = result["errors"]
+    return record
+
+# This function runs the design process of a problem and returns its record, it fails if no solutions could be generated
+def run_problem(pipeline, problem, explain):
+    start = time.perf_counter()
+    result = pipeline.run(problem["design_problem"], requirements=problem["requirements"], explain=explain)
+    if not any(results["solutions"] for results in result["categories"].values()):
+        raise RuntimeError(f"No solutions could be generated: {result['errors']}")
+    return build_record(problem, result, time.perf_counter() - start)
+
+# This function prints the throughput of the run and the OpenAI usage and estimated cost by model
+def print_summary(completed, skipped, failures, records, seconds, client):
+    solutions = sum(len(record[category]) for record in records for category in CATEGORIES)
+    explanations = [explanation for record in records for explanation in record["explanations"]]
+    minutes = max(seconds, 1e-9) / 60
+    print(f"\nDesign problems: {completed} completed, {skipped} already in the output, {len(failures)} failed")
+    print(f"Wall time: {seconds:.1f}s   Throughput: {completed / minutes:.2f} problems/min, {solutions / minutes:.1f} solutions/min, {len(explanations) / minutes:.1f} explanations/min")
+    if records:
+        print(f"Mean time per problem: {sum(record['seconds'] for record in records) / len(records):.1f}s")
+    if explanations:
+        print(f"Feature importance: {sum(explanation['api_calls'] for explanation in explanations)} API calls, {sum(explanation['cache_hits'] for explanation in explanations)} answered from the cache")
+
+    total_cost = 0.0
+    print(f"\n{'Model':<24}{'Requests':>10}{'Input tokens':>15}{'Output tokens':>15}{'Cost (USD)':>12}")
+    for model, usage in sorted(client.usage.items()):
+        cost = estimate_openai_cost(model, usage)
+        total_cost += cost or 0.0
+        print(f"{model:<24}{usage['requests']:>10}{usage['prompt_tokens']:>15}{usage['completion_tokens']:>15}{'unknown' if cost is None else f'{cost:.4f}':>12}")
+    print(f"Estimated cost: {total_cost:.4f} USD ({client.retries} retried requests)")
+
+    for problem, error in failures[:10]:
+        print(f"Failed {problem['id']} ({problem['design_problem'][:60]}): {error}")
+    if len(failures) > 10:
+        print(f"... and {len(failures) - 10} more failures")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the design process for many design problems.")
+    parser.add_argument("input", help="JSONL or CSV file with the design problems.")
+    parser.add_argument("output", help="JSONL file or Parquet directory where the results are written (the problems already in it are skipped).")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], help="Output format (by default jsonl for .jsonl outputs and parquet otherwise).")
+    parser.add_argument("--explain", action="store_true", help="Calculate the feature importance of every solution (many more API calls).")
+    parser.add_argument("--workers", type=int, default=4, help="Number of design problems run at the same time.")
+    parser.add_argument("--limit", type=int, help="Only run the first problems of the input.")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY"), help="OpenAI API key (OPENAI_API_KEY by default).")
+    parser.add_argument("--embedding-backend", help="Embeddings backend (openai or local, XAI_APP_EMBEDDING_BACKEND by default).")
+    parser.add_argument("--masked-lm", help="Masked LM of the feature importance (XAI_APP_MASKED_LM by default).")
+    parser.add_argument("--convergence-policy", choices=list(CONVERGENCE_POLICIES), help="Convergence check of the feature importance.")
+    parser.add_argument("--rows-per-file", type=int, default=1, help="Results per Parquet file (with more than 1 the results are buffered in memory until their file is written, so a crash loses them).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    if not args.api_key:
+        parser.error("an OpenAI API key is needed, set OPENAI_API_KEY or use --api-key")
+
+    problems = read_problems(args.input)[:args.limit]
+    writer = create_result_writer(args.output, args.format, args.rows_per_file)
+    completed_ids = writer.completed_ids()
+    pending = [problem for problem in problems if problem["id"] not in completed_ids]
+    print(f"{len(problems)} design problems, {len(problems) - len(pending)} already in the output, running {len(pending)} with {args.workers} workers")
+
+    client = get_openai_client(args.api_key)
+    config = PipelineConfig(embedding_backend=args.embedding_backend, masked_lm=args.masked_lm, convergence_policy=args.convergence_policy)
+    pipeline = DesignPipeline(client, config, PipelineCallbacks())
+
+    records = []
+    failures = []
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix="design-problem")
+    futures = {executor.submit(run_problem, pipeline, problem, args.explain): problem for problem in pending}
+
+    # This function writes the record of a finished problem (or records its failure)
+    def collect(future):
+        problem = futures.pop(future)
+        try:
+            record = future.result()
+        except Exception as e:
+            failures.append((problem, str(e)))
+            logging.error(f"Design problem {problem['id']} failed: {e}")
+            return
+        writer.write(record)
+        records.append(record)
+        print(f"[{len(records) + len(failures)}/{len(pending)}] {problem['id']} done in {record['seconds']:.1f}s")
+
+    # On the first interruption the queued problems are cancelled and the running ones are finished and written, on the second one the run stops immediately
+    interrupted = False
+    try:
+        for future in as_completed(list(futures)):
+            collect(future)
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\nInterrupted, finishing the running problems (press Ctrl+C again to stop now), the rest will run when the same command is repeated")
+        for future in list(futures):
+            if future.cancel():
+                futures.pop(future)
+        try:
+            for future in as_completed(list(futures)):
+                collect(future)
+        except KeyboardInterrupt:
+            pass
+    finally:
+        writer.close()
+        print_summary(len(records), len(problems) - len(pending), failures, records, time.perf_counter() - start, client)
+    if interrupted:
+        os._exit(130)  # Do not wait for the problems that are still running
+    executor.shutdown()
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,148 @@
+# THIS CODE INCLUDES THE HEADLESS PIPELINE OF THE DESIGN PROCESS (DIVERGENT THINKING -> EMBEDDINGS -> CLUSTERING -> FEATURE IMPORTANCE)
+
+# The pipeline takes an explicit OpenAI client, configuration and callbacks instead of the Streamlit session state, so it can run in worker processes, batch jobs and benchmarks
+# The pages are thin adapters over it: they create a DesignPipeline with the session client and StreamlitCallbacks, and keep its results in the session state
+
+# IMPORT LIBRARIES
+import random
+from XAI_APP_utils import PipelineCallbacks, generate_fbs_outputs, generate_embeddings, drop_failed_embeddings, get_embedding_backend, SimilarityEngine, reduce_and_cluster_categories, project_new_solutions, get_masked_lm, calculate_feature_importance, get_convergence_policy, CLUSTERING_PARAMETERS, REAGENT_WINDOW, REAGENT_JOB_SEED
+
+
+# DEFINE THE DESIGN PROCESS PROMPTS
+
+# Role descriptions of the LLM in the divergent (generation) and convergent (rating) stages
+DIVERGENT_ROLE_DESCRIPTION = "You are an experienced designer that is able to propose numerous innovative design proposals for FBS ontology design problems."
+CONVERGENT_ROLE_DESCRIPTION = "You are a design expert able to classify design proposals as bad, poor, regular, good or excellent."
+
+# Requirements that the designers can choose for their design problem (all of them are selected by default)
+DEFAULT_REQUIREMENTS = [
+    "Address buyer needs", "Innovation", "Ensure technical feasibility",
+    "Minimize cost", "Scalability", "Compliance with safety regulations",
+    "Compliance with energy regulations", "Sustainability", "Time efficiency"
+]
+
+# FBS elements to generate, each output key maps to its (ontology element, definition, example)
+FBS_ELEMENTS = {
+    "Functions_1": ("functions", "Functions define the **purpose** of the design, describing **what it is for**.", "increase engine power output, improve fuel efficiency, reduce emissions..."),
+    "Behaviors_1": ("behaviors", "Behaviors describe the **attributes** that can be derived from the design object’s structure, describing **what it does**.", "rotates at high speed using exhaust gases, compresses air to increase air mass flow, generates heat due to friction and pressure..."),
+    "Structures_1": ("structures", "Structures define the **physical components, materials, or topology** that make up the design, describing **what it consists of**. They should be tangible elements, NOT descriptions of behavior.", "compressor, turbine, rotating shaft, steel housing, ball bearings, intercooler pipes..."),
+}
+
+# This function returns the FBS category of an output key of the FBS elements (e.g. "Functions_1" -> "functions")
+def fbs_category(key):
+    return key.split("_")[0].lower()
+
+# Type of solution of each FBS category, used in the rating question of the feature importance
+FBS_INPUT_TYPES = {"functions": "functional", "behaviors": "behavioral", "structures": "structural"}
+
+# This function builds the question used to rate a solution and explain its rating
+def build_rating_input(option, type_of_input, design_problem):
+    return f"In one word how good is {option} as a {type_of_input} solution for {design_problem}?"
+
+
+# DEFINE THE PIPELINE
+
+# This class keeps the configuration of a pipeline, None values use the defaults of the app (and their XAI_APP_* environment variables)
+class PipelineConfig:
+    def __init__(self, embedding_backend=None, use_embedding_cache=True, clustering_parameters=None, masked_lm=None, convergence_policy=None, reagent_window=REAGENT_WINDOW, seed=REAGENT_JOB_SEED):
+        self.embedding_backend = embedding_backend
+        self.use_embedding_cache = use_embedding_cache
+        self.clustering_parameters = {**CLUSTERING_PARAMETERS, **(clustering_parameters or {})}
+        self.masked_lm = masked_lm
+        self.convergence_policy = convergence_policy
+        self.reagent_window = reagent_window
+        self.seed = seed
+
+# This class runs the steps of the design process, each step can be used on its own (as the pages do) or all of them at once with run
+class DesignPipeline:
+    def __init__(self, client=None, config=None, callbacks=None):
+        self.client = client
+        self.config = config or PipelineConfig()
+        self.callbacks = callbacks or PipelineCallbacks()
+
+    # This method generates the FBS solutions of a design problem, it returns the solutions of each FBS element and the errors of the ones that failed
+    def generate_solutions(self, design_problem, role_description=DIVERGENT_ROLE_DESCRIPTION, fbs_elements=FBS_ELEMENTS):
+        return generate_fbs_outputs(design_problem, role_description, fbs_elements, client=self.client, callbacks=self.callbacks)
+
+    # This method embeds a list of texts with the configured backend, with None for the texts that could not be embedded
+    def embed(self, texts, stage="embeddings"):
+        return generate_embeddings(texts, get_embedding_backend(self.config.embedding_backend), self.config.use_embedding_cache, client=self.client, callbacks=self.callbacks, stage=stage)
+
+    # This method embeds the solutions of each category, dropping the ones that could not be embedded, and returns (embeddings, solutions) by category
+    def embed_solutions(self, solutions_by_category):
+        return {category: drop_failed_embeddings(self.embed(solutions, stage=category), solutions) for category, solutions in solutions_by_category.items()}
+
+    # This method clusters the embeddings of each category and yields (category, (umap_embeddings, clusters, silhouette, ch_index, model)) as soon as each one finishes
+    def cluster(self, embeddings_by_category):
+        return reduce_and_cluster_categories(embeddings_by_category, callbacks=self.callbacks, **self.config.clustering_parameters)
+
+    # This method embeds new solutions and places them in an already clustered solution space, it returns their embeddings, solutions, UMAP coordinates and clusters
+    def add_solutions(self, model, solutions, stage="embeddings"):
+        embeddings, solutions = drop_failed_embeddings(self.embed(solutions, stage=stage), solutions)
+        if not embeddings:
+            return embeddings, solutions, None, None
+        umap_embeddings, clusters = project_new_solutions(model, embeddings)
+        return embeddings, solutions, umap_embeddings, clusters
+
+    # This method calculates the rating of a solution and the importance of each token of the rating question (see calculate_feature_importance)
+    # Unless a random generator is given, the perturbations are drawn from one seeded with the question so a solution always gets the same explanation
+    def explain(self, option, type_of_input, design_problem, role_description=CONVERGENT_ROLE_DESCRIPTION, rng=None, progress_callback=None):
+        original_input = build_rating_input(option, type_of_input, design_problem)
+        tokenizer, model = get_masked_lm(self.config.masked_lm)
+        return calculate_feature_importance(
+            original_input, role_description, tokenizer, model,
+            window=self.config.reagent_window,
+            convergence_policy=get_convergence_policy(self.config.convergence_policy),
+            client=self.client,
+            rng=rng or random.Random(f"{self.config.seed}:{original_input}"),
+            progress_callback=progress_callback,
+            callbacks=self.callbacks,
+        )
+
+    # This method matches each solution of every category with its most similar requirement, it adds a "requirements" DataFrame (see SimilarityEngine.most_similar) to the results of each category
+    def match_requirements(self, categories, requirements):
+        requirement_embeddings, requirement_labels = drop_failed_embeddings(self.embed(requirements, stage="requirements"), requirements)
+        if not requirement_embeddings:
+            return
+        for results in categories.values():
+            if results["embeddings"]:
+                results["requirements"] = SimilarityEngine(results["embeddings"], results["solutions"]).most_similar(requirement_embeddings, requirement_labels)
+
+    # This method runs the whole design process for a design problem and returns its results by category
+    # If requirements are given each solution is matched with its most similar requirement, and the feature importance of every solution is only calculated if explain is True
+    # The errors are keyed by category ("functions") for the generation and clustering errors, and by "category: option" for the feature importance errors
+    def run(self, design_problem, requirements=None, explain=False, divergent_role_description=DIVERGENT_ROLE_DESCRIPTION, convergent_role_description=CONVERGENT_ROLE_DESCRIPTION):
+        fbs_outputs, fbs_errors = self.generate_solutions(design_problem, divergent_role_description)
+        solutions_by_category = {fbs_category(key): solutions for key, solutions in fbs_outputs.items()}
+        errors = {fbs_category(key): error for key, error in fbs_errors.items()}
+
+        embedded = self.embed_solutions(solutions_by_category)
+        categories = {category: {"solutions": solutions, "embeddings": embeddings} for category, (embeddings, solutions) in embedded.items()}
+
+        # Only the categories with more solutions than UMAP neighbors and than the minimum cluster size can be clustered
+        min_solutions = max(self.config.clustering_parameters["n_neighbors"], self.config.clustering_parameters["min_cluster_size"]) + 1
+        clusterable = {category: embeddings for category, (embeddings, _) in embedded.items() if len(embeddings) >= min_solutions}
+        for completed, (category, (umap_embeddings, clusters, silhouette, ch_index, model)) in enumerate(self.cluster(clusterable), start=1):
+            categories[category].update({"umap": umap_embeddings, "clusters": clusters, "silhouette": silhouette, "ch_index": ch_index, "model": model})
+            self.callbacks.progress("clustering", completed, len(clusterable))
+        for category in categories:
+            if category not in clusterable:
+                errors.setdefault(category, "There are not enough solutions to cluster this category.")
+
+        if requirements:
+            self.match_requirements(categories, requirements)
+
+        if explain:
+            total = sum(len(category["solutions"]) for category in categories.values())
+            completed = 0
+            for category, results in categories.items():
+                results["explanations"] = {}
+                for option in results["solutions"]:
+                    try:
+                        results["explanations"][option] = self.explain(option, FBS_INPUT_TYPES.get(category, category), design_problem, convergent_role_description)
+                    except Exception as e:
+                        errors[f"{category}: {option}"] = str(e)
+                    completed += 1
+                    self.callbacks.progress("explanations", completed, total)
+
+        return {"design_problem": design_problem, "categories": categories, "errors": errors}
\ No newline at end of file
@@ -1,40 +1,93 @@
 # THIS CODE INCLUDES THE DIFFERENT FUNCTIONS THAT WE WILL BE USING IN OTHER PAGES
 
 # IMPORT LIBRARIES
+# The heavy libraries (torch, transformers, umap, hdbscan, sklearn, scipy, plotly and nltk) are imported inside the functions that use them, so the pages that do not need them (e.g. Divergent Thinking) start fast
 import streamlit as st
+import abc
 import re
-from sklearn.preprocessing import StandardScaler
-import umap
-import hdbscan
-import plotly.express as px
-from sklearn.metrics.pairwise import cosine_similarity
 import pandas as pd
 import numpy as np
-from openai import OpenAI
-from transformers import RobertaTokenizer, RobertaForMaskedLM
 import random
 random.seed(42) # Introduce a seed to reduce variability
-import torch
 np.random.seed(42) # Itroduce a seed to reduce variability
 import math
-from IPython.display import HTML, display
 import unicodedata
 import json
-from scipy.special import softmax
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import silhouette_score, calinski_harabasz_score
-from nltk.corpus import wordnet as wn
-from sklearn.preprocessing import normalize
-from sklearn.metrics.pairwise import cosine_distances
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+from collections import OrderedDict
+import threading
+import os
+import sqlite3
+import hashlib
+import pickle
+import zipfile
+import time
+import logging
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+logger = logging.getLogger("XAI_APP")
 
 
 # DEFINE THE FUNCTIONS TO USE
 
+# 0. PIPELINE CALLBACKS FUNCTIONS
+
+# The pipeline functions (FBS generation, embeddings, clustering and feature importance) do not call Streamlit directly, they report their warnings, errors and progress to a callbacks object
+# These default callbacks write them to the log, so the functions can also run in worker processes, batch jobs and benchmarks (see XAI_APP_pipeline.py)
+class PipelineCallbacks:
+    def warning(self, message):
+        logger.warning(message)
+
+    def error(self, message):
+        logger.error(message)
+
+    # This method reports the units of a stage completed so far (e.g. embedded texts), the last call of a stage has completed == total
+    def progress(self, stage, completed, total):
+        pass
+
+# These callbacks display the warnings, errors and progress bars in the page that runs the pipeline
+class StreamlitCallbacks(PipelineCallbacks):
+    def __init__(self):
+        self.progress_bars = {}
+
+    def warning(self, message):
+        st.warning(message)
+
+    def error(self, message):
+        st.error(message)
+
+    def progress(self, stage, completed, total):
+        if completed >= total:
+            if stage in self.progress_bars:
+                self.progress_bars.pop(stage).empty()  # Clear progress bar
+            return
+        if stage not in self.progress_bars:
+            self.progress_bars[stage] = st.progress(0)  # Initialize progress bar
+        self.progress_bars[stage].progress(completed / total)
+
+# This function returns the given callbacks or, if there are none, the Streamlit ones when it is called from a page and the logging ones otherwise
+def get_callbacks(callbacks=None):
+    if callbacks is not None:
+        return callbacks
+    return StreamlitCallbacks() if get_script_run_ctx(suppress_warning=True) is not None else PipelineCallbacks()
+
+# This function returns the given OpenAI client or, if there is none and it is called from a page, the one stored in the session state (None if there is no client)
+def get_client(client=None):
+    if client is None and get_script_run_ctx(suppress_warning=True) is not None:
+        client = st.session_state.get("client")
+    return client
+
+# This function attaches the Streamlit script context (if there is one) to a worker thread, so the Streamlit callbacks can display messages from it
+def attach_script_run_ctx(ctx):
+    if ctx is not None:
+        add_script_run_ctx(threading.current_thread(), ctx)
+
+
 # 1. DIVERGENT THINKING FUNCTIONS
     
 # This function generates Chat o1 answers for a given design problem and FBS ontology element
-def generate_design_output(design_problem, ontology_element, role_description, ontology_element_definition, ontology_element_example):
+def generate_design_output(design_problem, ontology_element, role_description, ontology_element_definition, ontology_element_example, client=None, callbacks=None):
     prompt = (
         #f"Design Goal: '{design_problem}'\n"
         #    f"Your task is to propose as many distinct and creative '{ontology_element}' as possible for the given Design Goal.\n"
@@ -55,14 +108,17 @@ def generate_design_output(design_problem, ontology_element, role_description, o
             f"Correctness and diversity are the most important criteria, followed by quantity and relevance.\n"
             f"--- END OF TASK ---\n"
     )
+    client = get_client(client)
+    callbacks = get_callbacks(callbacks)
+
     # Check if the openai client can be accessed
-    if "client" not in st.session_state:
-        st.error("OpenAI client is not initialized. Please provide a valid API key.")
+    if client is None:
+        callbacks.error("OpenAI client is not initialized. Please provide a valid API key.")
         return None
 
-    # Generate an answer if the openai client can be access
+    # Generate an answer if the openai client can be access (the shared client waits for the rate limit and retries the temporary errors)
     try:
-        response = st.session_state.client.chat.completions.create(
+        response = client.chat_completion(
             model="o1-mini", # Since all the design process relies on this stage we will use the latest model in its mini version to assure also fast replies and a good UX
             messages=[
                 #{"role": "system", "content": role_description},
@@ -72,7 +128,7 @@ def generate_design_output(design_problem, ontology_element, role_description, o
 
         # Validate response structure
         if not hasattr(response, "choices") or not response.choices:
-            st.warning("The API response did not contain valid choices.")
+            callbacks.warning("The API response did not contain valid choices.")
             return []
 
         # Extract the response content to prepare it before returning it in the function call
@@ -80,10 +136,10 @@ def generate_design_output(design_problem, ontology_element, role_description, o
 
         # Check if the content is empty or improperly formatted
         if not content:
-            st.warning("The response was empty.")
+            callbacks.warning("The response was empty.")
             return []
         if "," not in content:
-            st.warning(f"Unexpected response format: {content}")
+            callbacks.warning(f"Unexpected response format: {content}")
             return []
 
         # Process the response into a list of solutions for the future data handling
@@ -102,32 +158,311 @@ def generate_design_output(design_problem, ontology_element, role_description, o
         return solutions
 
     except Exception as e:
-        st.error(f"Error generating response: {e}")
+        callbacks.error(f"Error generating response: {e}")
         return None
-    
+
+# This function generates the answers for several FBS ontology elements at the same time, the o1-mini requests are sent concurrently so the user only waits for the slowest one instead of for all of them
+def generate_fbs_outputs(design_problem, role_description, fbs_elements, client=None, callbacks=None):
+    # fbs_elements maps each output key (e.g. "Functions_1") to its (ontology_element, ontology_element_definition, ontology_element_example) tuple
+    results = {}
+    errors = {}
+    client = get_client(client)
+    callbacks = get_callbacks(callbacks)
+
+    # Attach the Streamlit script context (if the function is called from a page) to the worker threads so they can display warnings
+    ctx = get_script_run_ctx(suppress_warning=True)
+    with ThreadPoolExecutor(max_workers=len(fbs_elements), initializer=attach_script_run_ctx, initargs=(ctx,)) as executor:
+        futures = {
+            executor.submit(generate_design_output, design_problem, ontology_element, role_description, ontology_element_definition, ontology_element_example, client, callbacks): key
+            for key, (ontology_element, ontology_element_definition, ontology_element_example) in fbs_elements.items()
+        }
+        # Gather the results as they finish, keeping track of the categories that failed
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                output = None
+                errors[key] = str(e)
+            if output is None:
+                errors.setdefault(key, "No solutions could be generated for this category.")
+                output = []
+            results[key] = output
+
+    # Return the results in the same order as the given elements
+    return {key: results[key] for key in fbs_elements}, errors
+
 
 # 2.0 FILTERING FUNCTIONS
 
-# This function creates embeddings for a text list using openai API fast embedding model "ext-embedding-3-small" to assure quick results
-def generate_embeddings(text_list, model="text-embedding-3-small"):
-    embeddings = []
-    progress_bar = st.progress(0)  # Initialize progress bar
-    for i, text in enumerate(text_list):
+# Define where the embeddings cache is stored and how many embeddings it keeps (an empty path disables the cache)
+EMBEDDING_CACHE_PATH = os.environ.get("XAI_APP_EMBEDDING_CACHE", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("XAI_APP_EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+
+# This class stores the generated embeddings in an on-disk SQLite database keyed by (model, dimensions, normalized text), it is shared by all the sessions of the server so the same texts are never embedded twice
+class EmbeddingCache:
+    def __init__(self, path, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")  # Allow several server processes to read while one writes
+            self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, dimensions INTEGER, text TEXT, vector BLOB, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self.connection.commit()
+
+    # This function builds the content address of a text for a given model and embedding size
+    @staticmethod
+    def make_key(model, dimensions, text):
+        return hashlib.sha256(f"{model}\x1f{dimensions}\x1f{text}".encode("utf-8")).hexdigest()
+
+    # This function returns a dictionary with the cached embeddings of the given texts, refreshing their last use to keep them from being evicted
+    def get_many(self, model, dimensions, texts):
+        keys = {self.make_key(model, dimensions, text): text for text in texts}
+        key_list = list(keys)
+        found = {}
+        with self.lock:
+            for start in range(0, len(key_list), 500):  # Stay below the SQLite variable limit
+                chunk = key_list[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, vector in rows:
+                    found[keys[key]] = np.frombuffer(vector, dtype=np.float32).copy()
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, self.make_key(model, dimensions, text)) for text in found]
+                )
+                self.connection.commit()
+        return found
+
+    # This function stores a dictionary of text embeddings and evicts the least recently used ones if the cache grows over its maximum size
+    def put_many(self, model, dimensions, embeddings_by_text):
+        now = time.time()
+        rows = [
+            (self.make_key(model, dimensions, text), model, dimensions, text, np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in embeddings_by_text.items()
+        ]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)", rows)
+            count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self.connection.commit()
+
+# The cache is created once per server process and shared by all the sessions
+embedding_cache = None
+embedding_cache_lock = threading.Lock()
+
+# This function returns the shared embeddings cache, creating it the first time it is needed (None if it is disabled or cannot be opened)
+def get_embedding_cache(callbacks=None):
+    global embedding_cache
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    with embedding_cache_lock:
+        if embedding_cache is None:
+            try:
+                embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+            except sqlite3.Error as e:
+                get_callbacks(callbacks).warning(f"The embeddings cache could not be opened, embeddings will not be cached: {e}")
+                return None
+    return embedding_cache
+
+# This function normalizes a text before embedding it so equivalent texts share the same cache entry
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+# EMBEDDING BACKENDS
+# Every backend has a name (used as the model of the cache key), its embedding dimensions (None when fixed by the model), whether it needs the OpenAI client, and an embed(texts, progress_callback, client, callbacks) method returning one float32 vector per text (None for the texts that could not be embedded)
+class EmbeddingBackend(abc.ABC):
+    name = None
+    dimensions = None
+    requires_client = False
+
+    @abc.abstractmethod
+    def embed(self, texts, progress_callback=None, client=None, callbacks=None):
+        pass
+
+# This backend uses openai API fast embedding model "text-embedding-3-small" to assure quick results, the texts are sent in batches limited in size
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    requires_client = True
+
+    def __init__(self, model="text-embedding-3-small", dimensions=None, batch_size=256, max_batch_characters=100000):
+        self.name = model
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.max_batch_characters = max_batch_characters
+
+    def embed(self, texts, progress_callback=None, client=None, callbacks=None):
+        embeddings = [None] * len(texts)
+        client = get_client(client)
+        callbacks = get_callbacks(callbacks)
+        if client is None:
+            callbacks.error("OpenAI client is not initialized. Please provide a valid API key.")
+            return embeddings
+
+        # Group the text indices in batches limited both in number of texts and in total length
+        batches = []
+        current_batch = []
+        current_characters = 0
+        for i, text in enumerate(texts):
+            if current_batch and (len(current_batch) >= self.batch_size or current_characters + len(text) > self.max_batch_characters):
+                batches.append(current_batch)
+                current_batch = []
+                current_characters = 0
+            current_batch.append(i)
+            current_characters += len(text)
+        if current_batch:
+            batches.append(current_batch)
+
+        completed = 0
+        for batch in batches:
+            self.embed_batch(texts, batch, embeddings, client, callbacks)
+            completed += len(batch)
+            if progress_callback:
+                progress_callback(completed, len(texts))
+        return embeddings
+
+    # This function embeds a batch of texts and stores the results in their position of the embeddings list, if the request fails the batch is split in halves and retried so only the failing texts are lost
+    # Rate limits and server errors are already retried by the shared client, if they persist splitting the batch would only send more requests so the batch is skipped
+    def embed_batch(self, texts, indices, embeddings, client, callbacks):
         try:
-            response = st.session_state.client.embeddings.create(
-                model=model,
-                input=text
+            response = client.create_embeddings(
+                model=self.name,
+                input=[texts[i] for i in indices],
+                **({"dimensions": self.dimensions} if self.dimensions else {})
             )
-            embeddings.append(response.data[0].embedding)
+            # Map each returned embedding back to its input position
+            for item in response.data:
+                embeddings[indices[item.index]] = np.asarray(item.embedding, dtype=np.float32)
         except Exception as e:
-            embeddings.append(None)
-            st.warning(f"Error generating embedding for '{text}': {e}")
-        progress_bar.progress((i + 1) / len(text_list))  # Update progress
-    progress_bar.empty()  # Clear progress bar
-    return [e for e in embeddings if e is not None]
+            if is_retryable_openai_error(e):
+                callbacks.warning(f"Error generating embeddings for {len(indices)} texts: {e}")
+            elif len(indices) > 1:
+                middle = len(indices) // 2
+                self.embed_batch(texts, indices[:middle], embeddings, client, callbacks)
+                self.embed_batch(texts, indices[middle:], embeddings, client, callbacks)
+            else:
+                callbacks.warning(f"Error generating embedding for '{texts[indices[0]]}': {e}")
+
+# This backend runs a locally stored encoder on the CPU (by default the same roberta-base weights used for ReAgent) and mean-pools its last hidden states, so the filtering works without network access
+# If the encoder is the checkpoint of the ReAgent masked LM and it runs in eager mode, the encoder of the shared masked LM is reused instead of loading a second copy of the weights
+class LocalEmbeddingBackend(EmbeddingBackend):
+    requires_client = False
+
+    def __init__(self, model_name="roberta-base", batch_size=32, max_length=512):
+        self.name = f"local:{model_name}"
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.shares_masked_lm = MASKED_LM_BACKEND == "eager" and MASKED_LM_MODELS.get(MASKED_LM_NAME, MASKED_LM_NAME) == model_name
+        if self.shares_masked_lm:
+            self.tokenizer, masked_lm = get_masked_lm()
+            self.model = masked_lm.model.base_model  # The encoder without the language modeling head (same hidden states as AutoModel)
+            self.lock = masked_lm_inference_lock  # The forward passes are serialized with the ones of ReAgent
+        else:
+            from transformers import AutoTokenizer, AutoModel
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.model = AutoModel.from_pretrained(model_name)
+            self.model.eval()  # Set the model to evaluation mode
+            self.lock = threading.Lock()  # The model is shared by all the sessions
+
+    def embed(self, texts, progress_callback=None, client=None, callbacks=None):
+        import torch
+        callbacks = get_callbacks(callbacks)
+        embeddings = [None] * len(texts)
+        encoded = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+
+        # Sort the texts by length so each padded batch holds texts of similar length (length bucketing)
+        order = sorted(range(len(texts)), key=lambda i: len(encoded["input_ids"][i]))
+
+        completed = 0
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            try:
+                inputs = self.tokenizer.pad(
+                    {key: [encoded[key][i] for i in batch] for key in ("input_ids", "attention_mask")},
+                    return_tensors="pt"
+                )
+                with self.lock, torch.no_grad():
+                    hidden_states = self.model(**inputs).last_hidden_state
+                # Mean pooling over the non padding tokens
+                mask = inputs["attention_mask"].unsqueeze(-1).to(hidden_states.dtype)
+                pooled = (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+                for i, vector in zip(batch, pooled.numpy().astype(np.float32)):
+                    embeddings[i] = vector
+            except Exception as e:
+                callbacks.warning(f"Error generating local embeddings for {len(batch)} texts: {e}")
+            completed += len(batch)
+            if progress_callback:
+                progress_callback(completed, len(texts))
+        return embeddings
+
+# Define which embeddings backend is used ("openai" or "local") and which local encoder is loaded
+EMBEDDING_BACKEND = os.environ.get("XAI_APP_EMBEDDING_BACKEND", "openai")
+LOCAL_EMBEDDING_MODEL = os.environ.get("XAI_APP_LOCAL_EMBEDDING_MODEL", "roberta-base")
+
+# The backends are created once per server process and shared by all the sessions
+embedding_backends = {}
+embedding_backends_lock = threading.Lock()
+
+# This function returns the configured embeddings backend, creating it the first time it is needed
+def get_embedding_backend(backend_name=None):
+    backend_name = backend_name or EMBEDDING_BACKEND
+    with embedding_backends_lock:
+        if backend_name not in embedding_backends:
+            if backend_name == "openai":
+                embedding_backends[backend_name] = OpenAIEmbeddingBackend()
+            elif backend_name == "local":
+                embedding_backends[backend_name] = LocalEmbeddingBackend(LOCAL_EMBEDDING_MODEL)
+            else:
+                raise ValueError(f"Unknown embeddings backend '{backend_name}', use 'openai' or 'local'.")
+        return embedding_backends[backend_name]
+
+# This function creates embeddings for a text list with the selected backend
+# The embeddings already stored in the cache are reused and only the rest of the texts are embedded. The embeddings are returned in the same order as the given texts, with None for the texts that could not be embedded
+def generate_embeddings(text_list, backend=None, use_cache=True, client=None, callbacks=None, stage="embeddings"):
+    backend = backend or get_embedding_backend()
+    callbacks = get_callbacks(callbacks)
+    normalized_texts = [normalize_text(text) for text in text_list]
+    cache = get_embedding_cache(callbacks) if use_cache else None
+
+    # Look for the embeddings that were already generated
+    embeddings_by_text = cache.get_many(backend.name, backend.dimensions, set(normalized_texts)) if cache else {}
+
+    # Only the unique texts that are not cached are embedded
+    pending_texts = list(dict.fromkeys(text for text in normalized_texts if text not in embeddings_by_text))
+    if pending_texts:
+        callbacks.progress(stage, 0, len(pending_texts))
+        pending_embeddings = backend.embed(pending_texts, lambda completed, total: callbacks.progress(stage, completed, total), client, callbacks)
+        callbacks.progress(stage, len(pending_texts), len(pending_texts))
+
+        # Store the new embeddings in the cache
+        new_embeddings = {text: embedding for text, embedding in zip(pending_texts, pending_embeddings) if embedding is not None}
+        if cache and new_embeddings:
+            cache.put_many(backend.name, backend.dimensions, new_embeddings)
+        embeddings_by_text.update(new_embeddings)
+
+    return [embeddings_by_text.get(text) for text in normalized_texts]
+
+# This function removes the texts whose embedding could not be generated, keeping the remaining embeddings aligned with their labels
+def drop_failed_embeddings(embeddings, labels):
+    kept_embeddings = []
+    kept_labels = []
+    for embedding, label in zip(embeddings, labels):
+        if embedding is not None:
+            kept_embeddings.append(embedding)
+            kept_labels.append(label)
+    return kept_embeddings, kept_labels
 
 # This function generates conceptualized terms for a given list to increase the semantic space and improve clustering creation
 def enrich_with_wordnet(data_list):
+    from nltk.corpus import wordnet as wn
     enriched_list = []
     # Iterate through the data list, split each of the entries and generate hypernyms and synonums for each of thme
     for entry in data_list:
@@ -143,8 +478,37 @@ def enrich_with_wordnet(data_list):
         enriched_list.append(" ".join(set(conceptualized)))  # Remove duplicates
     return enriched_list
 
-# This function reduces embeddings dimensions and creates density based clusters based on them
-def reduce_and_cluster(embeddings):
+# Define the default dimensionality reduction and clustering hyperparameters, since we are working with small noisy datasets this parameters ensure a useful visualization for the users
+CLUSTERING_PARAMETERS = {"n_neighbors": 5, "min_dist": 0.1, "n_components": 3, "min_cluster_size": 3, "min_samples": 2, "random_state": 42}
+
+# This class keeps the fitted scaler, PCA, UMAP and HDBSCAN models of a solution space, so new solutions can be placed on an existing map without refitting it
+class SolutionSpaceModel:
+    def __init__(self, scaler, pca, reducer, clusterer):
+        self.scaler = scaler
+        self.pca = pca
+        self.reducer = reducer
+        self.clusterer = clusterer
+
+    # This function projects new embeddings into the fitted UMAP space
+    def transform(self, embeddings):
+        normalized_embeddings = self.scaler.transform(np.asarray(embeddings, dtype=np.float32))
+        return self.reducer.transform(self.pca.transform(normalized_embeddings))
+
+    # This function projects new embeddings and assigns them to the existing clusters with the HDBSCAN approximate prediction
+    def predict(self, embeddings):
+        import hdbscan
+        umap_embeddings = self.transform(embeddings)
+        clusters, _ = hdbscan.approximate_predict(self.clusterer, umap_embeddings)
+        return umap_embeddings, clusters
+
+# This function reduces embeddings dimensions and creates density based clusters based on them, if return_model is True the fitted models are also returned as a SolutionSpaceModel
+def reduce_and_cluster(embeddings, n_neighbors=5, min_dist=0.1, n_components=3, min_cluster_size=3, min_samples=2, random_state=42, return_model=False):
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.decomposition import PCA
+    from sklearn.metrics import silhouette_score, calinski_harabasz_score
+    import umap
+    import hdbscan
+
     # Log the dimensionality reduction and clustering process
     scaler = StandardScaler()
     normalized_embeddings = scaler.fit_transform(embeddings)
@@ -155,7 +519,7 @@ def reduce_and_cluster(embeddings):
     reduced_embeddings = pca.fit_transform(normalized_embeddings)
     
     # Apply UMAP
-    reducer = umap.UMAP(n_neighbors=5, min_dist=0.1, metric="cosine", random_state=42, n_components=3) # Since we are working with small noise datasets this parameters ensure a useful visualization for the users
+    reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric="cosine", random_state=random_state, n_components=n_components) # Since we are working with small noise datasets this parameters ensure a useful visualization for the users
     umap_embeddings = reducer.fit_transform(reduced_embeddings)
 
     # Precompute cosine distances for HDBSCAN
@@ -164,7 +528,7 @@ def reduce_and_cluster(embeddings):
     # Cluster using HDBSCAN
     #clusterer = hdbscan.HDBSCAN(min_cluster_size=3, min_samples=2, metric="precomputed")
     #clusters = clusterer.fit_predict(distance_matrix)
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=3, min_samples=2, metric="euclidean") # Since we are working with small noisy datasets this parameters ensure a useful visualization for the users. Eventhough, a prior, it may seem that cosine would work better than euclidean, after trying it it seems euclidean is a better choice
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples, metric="euclidean", prediction_data=return_model) # Since we are working with small noisy datasets this parameters ensure a useful visualization for the users. Eventhough, a prior, it may seem that cosine would work better than euclidean, after trying it it seems euclidean is a better choice
     clusters = clusterer.fit_predict(umap_embeddings)
 
     # Evaluate clustering
@@ -176,10 +540,225 @@ def reduce_and_cluster(embeddings):
         silhouette_avg = silhouette_score(valid_embeddings, valid_clusters)
         ch_index = calinski_harabasz_score(valid_embeddings, valid_clusters)
 
+    if return_model:
+        return umap_embeddings, clusters, silhouette_avg, ch_index, SolutionSpaceModel(scaler, pca, reducer, clusterer)
     return umap_embeddings, clusters, silhouette_avg, ch_index
 
+# This function places new solutions on an existing solution space, returning their UMAP coordinates and their approximate clusters
+def project_new_solutions(model, embeddings):
+    umap_embeddings, clusters = model.predict(embeddings)
+    return np.asarray(umap_embeddings), np.asarray(clusters)
+
+# Define where the clustering results are stored on disk (an empty path keeps them only in memory) and how many of them are kept
+# The fitted models are stored with pickle, and loading a pickle can run arbitrary code, so the directory must only be writable by the user running the app (it is created with owner-only permissions)
+CLUSTERING_CACHE_DIRECTORY = os.environ.get("XAI_APP_CLUSTERING_CACHE", "clustering_cache")
+CLUSTERING_CACHE_MAX_ENTRIES = int(os.environ.get("XAI_APP_CLUSTERING_CACHE_MAX_ENTRIES", 64))
+CLUSTERING_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("XAI_APP_CLUSTERING_CACHE_MAX_DISK_ENTRIES", 1000))
+
+# This class memoizes the reduce_and_cluster results (UMAP coordinates, clusters, silhouette and CH scores and the fitted models) keyed by the content of the embeddings matrix and the hyperparameters
+# The most recently used results are kept in memory and, if a directory is given, also written to disk so they survive evictions and server restarts
+class ClusteringCache:
+    def __init__(self, max_entries=CLUSTERING_CACHE_MAX_ENTRIES, directory=None, max_disk_entries=CLUSTERING_CACHE_MAX_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            try:
+                os.chmod(directory, 0o700)  # Restrict an existing directory too
+            except OSError:
+                pass
+
+    # This function checks that the models of the directory can be unpickled: on POSIX systems the directory must be owned by the current user and not writable by anyone else
+    def trusted_directory(self):
+        if not hasattr(os, "getuid"):
+            return True
+        try:
+            status = os.stat(self.directory)
+        except OSError:
+            return False
+        return status.st_uid == os.getuid() and not status.st_mode & 0o022
+
+    # This function hashes the embeddings matrix together with the clustering hyperparameters
+    @staticmethod
+    def make_key(embeddings, parameters):
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+        digest = hashlib.sha256()
+        digest.update(str(matrix.shape).encode("utf-8"))
+        digest.update(matrix.tobytes())
+        digest.update(json.dumps(parameters, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    # This function returns the cached results of a key (None if they are not cached)
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)  # Mark as recently used
+                return self.entries[key]
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, f"{key}.npz")
+        try:
+            with np.load(path) as data:
+                silhouette_avg = None if np.isnan(data["silhouette"]) else float(data["silhouette"])
+                ch_index = None if np.isnan(data["ch"]) else float(data["ch"])
+                umap_embeddings = data["umap"]
+                clusters = data["clusters"]
+            os.utime(path)  # Mark as recently used on disk
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile, EOFError):  # Missing or corrupt files are cache misses
+            return None
+        # The fitted models are stored next to the results, without them new solutions cannot be projected (they are only unpickled from a trusted directory)
+        model = None
+        try:
+            if self.trusted_directory():
+                with open(os.path.join(self.directory, f"{key}.model.pkl"), "rb") as file:
+                    model = pickle.load(file)
+            else:
+                logger.warning("The clustering cache directory %s can be written by other users, its models are not loaded.", self.directory)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+        results = (umap_embeddings, clusters, silhouette_avg, ch_index, model)
+        self.put_in_memory(key, results)
+        return results
+
+    # This function stores the results of a key in memory and on disk
+    def put(self, key, results, callbacks=None):
+        self.put_in_memory(key, results)
+        if not self.directory:
+            return
+        umap_embeddings, clusters, silhouette_avg, ch_index, model = results
+        try:
+            # The model is written before the results, so a session that finds the results also finds their model
+            if model is not None:
+                self.write_file(f"{key}.model.pkl", lambda file: pickle.dump(model, file))
+            self.write_file(f"{key}.npz", lambda file: np.savez(
+                file,
+                umap=umap_embeddings,
+                clusters=clusters,
+                silhouette=np.nan if silhouette_avg is None else silhouette_avg,
+                ch=np.nan if ch_index is None else ch_index,
+            ))
+            # Remove the least recently used files if the disk cache grows over its maximum size
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")]
+            if len(paths) > self.max_disk_entries:
+                paths.sort(key=os.path.getmtime)
+                for old_path in paths[:len(paths) - self.max_disk_entries]:
+                    os.remove(old_path)
+                    model_path = old_path[:-len(".npz")] + ".model.pkl"
+                    if os.path.exists(model_path):
+                        os.remove(model_path)
+        except (OSError, pickle.PicklingError) as e:
+            get_callbacks(callbacks).warning(f"The clustering results could not be written to disk: {e}")
+
+    # This function writes a file of the cache directory through a temporary file that is then renamed, so the other sessions never read a partially written file
+    def write_file(self, name, write):
+        path = os.path.join(self.directory, name)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "wb") as file:
+                write(file)
+            os.replace(temporary_path, path)  # Atomic
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def put_in_memory(self, key, results):
+        with self.lock:
+            self.entries[key] = results
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)  # Evict the least recently used results
+
+# The clustering cache is shared by all the sessions of the server
+clustering_cache = ClusteringCache(directory=CLUSTERING_CACHE_DIRECTORY or None)
+
+# This function returns the reduce_and_cluster results (including the fitted models) of some embeddings, only computing them if they are not cached
+def cached_reduce_and_cluster(embeddings, callbacks=None, **parameters):
+    parameters = {**CLUSTERING_PARAMETERS, **parameters}
+    key = ClusteringCache.make_key(embeddings, parameters)
+    results = clustering_cache.get(key)
+    if results is None:
+        results = reduce_and_cluster(embeddings, return_model=True, **parameters)
+        clustering_cache.put(key, results, callbacks)
+    return results
+
+# This function limits the BLAS and numba threads of a clustering worker process, so the parallel UMAP and HDBSCAN fits do not oversubscribe the CPU cores
+def limit_worker_threads(n_threads):
+    from threadpoolctl import threadpool_limits  # Installed with scikit-learn
+    threadpool_limits(limits=n_threads)
+    import numba  # Installed with umap-learn
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+# The clustering workers are started once per server process and shared by all the sessions, so their imports and the numba compilation are only paid once
+clustering_pool = None
+clustering_pool_lock = threading.Lock()
+CLUSTERING_WORKERS = 3  # One worker for each FBS category
+
+# This function returns the shared clustering process pool, creating it the first time it is needed
+def get_clustering_pool():
+    global clustering_pool
+    with clustering_pool_lock:
+        if clustering_pool is None:
+            n_threads = max(1, (os.cpu_count() or 1) // CLUSTERING_WORKERS)
+            clustering_pool = ProcessPoolExecutor(
+                max_workers=CLUSTERING_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),  # Forking the multithreaded server is not safe
+                initializer=limit_worker_threads,
+                initargs=(n_threads,),
+            )
+        return clustering_pool
+
+# This function runs reduce_and_cluster for several categories in parallel processes and yields (category, results) as soon as each one finishes, the categories whose results are cached are returned directly
+# The results include the fitted models of each category, so new solutions can be projected later
+def reduce_and_cluster_categories(embeddings_by_category, callbacks=None, **parameters):
+    global clustering_pool
+    parameters = {**CLUSTERING_PARAMETERS, **parameters}
+    callbacks = get_callbacks(callbacks)
+
+    # Return the cached results first and only cluster the rest
+    keys = {}
+    pending = set()
+    for category, embeddings in embeddings_by_category.items():
+        keys[category] = ClusteringCache.make_key(embeddings, parameters)
+        results = clustering_cache.get(keys[category])
+        if results is None:
+            pending.add(category)
+        else:
+            yield category, results
+
+    try:
+        pool = get_clustering_pool() if pending else None
+        futures = {pool.submit(reduce_and_cluster, np.asarray(embeddings_by_category[category], dtype=np.float32), return_model=True, **parameters): category for category in pending}
+    except Exception as e:
+        callbacks.warning(f"The clustering could not be run in parallel, running it sequentially: {e}")
+        futures = {}
+    for future in as_completed(futures):
+        category = futures[future]
+        try:
+            results = future.result()
+        except Exception as e:
+            # A crashed worker breaks the pool, so it is recreated next time and the category is clustered in this process
+            callbacks.warning(f"The parallel clustering of {category} failed, running it sequentially: {e}")
+            with clustering_pool_lock:
+                if clustering_pool is pool:
+                    pool.shutdown(wait=False)
+                    clustering_pool = None
+            continue
+        pending.discard(category)
+        clustering_cache.put(keys[category], results, callbacks)
+        yield category, results
+    for category in embeddings_by_category:
+        if category in pending:
+            results = reduce_and_cluster(np.asarray(embeddings_by_category[category], dtype=np.float32), return_model=True, **parameters)
+            clustering_cache.put(keys[category], results, callbacks)
+            yield category, results
+
 # This function creates an interactive embedding space to allow the user visualize each of the LLM generated solutions
 def plot_interactive_clusters(umap_embeddings, clusters, labels, title):
+    import plotly.express as px
+
     # Check the dimensionality of the embeddings
     dimensions = umap_embeddings.shape[1]
     
@@ -209,14 +788,280 @@ def plot_interactive_clusters(umap_embeddings, clusters, labels, title):
     # Display the plot in Streamlit
     st.plotly_chart(fig, use_container_width=True)
 
+# This class keeps the L2-normalized float32 embeddings matrix of a solutions list, so the cosine similarities against any number of references are computed with a single matrix product
+class SimilarityEngine:
+    def __init__(self, embeddings, labels):
+        self.matrix = to_normalized_matrix(embeddings)
+        self.labels = np.asarray(labels, dtype=object)
+
+    # This function returns the (references x solutions) cosine similarity matrix
+    def scores(self, reference_embeddings):
+        references = to_normalized_matrix(reference_embeddings)
+        if len(references) == 0 or len(self.matrix) == 0:
+            return np.zeros((len(references), len(self.matrix)), dtype=np.float32)  # The dimensions of an empty list are unknown
+        return references @ self.matrix.T
+
+    # This function returns the solutions ordered by their similarity with a reference embedding, only the top_k most similar ones if given
+    def rank(self, reference_embedding, top_k=None):
+        similarities = self.scores(reference_embedding)[0]
+        if top_k is not None and top_k < len(similarities):
+            top_indices = np.argpartition(-similarities, top_k - 1)[:top_k]  # Select the top_k without sorting all the solutions
+            order = top_indices[np.argsort(-similarities[top_indices], kind="stable")]
+        else:
+            order = np.argsort(-similarities, kind="stable")
+        return pd.DataFrame({"Solution": self.labels[order], "Similarity": similarities[order]})
+
+    # This function returns each solution with its most similar reference (e.g. requirement) and their similarity
+    def most_similar(self, reference_embeddings, reference_labels):
+        similarities = self.scores(reference_embeddings).T  # (solutions x references)
+        if similarities.size == 0:  # No solutions or no references
+            return pd.DataFrame({"Solution": [], "Most Similar Requirement": [], "Similarity": []})
+        most_similar_indices = similarities.argmax(axis=1)
+        return pd.DataFrame({
+            "Solution": self.labels,
+            "Most Similar Requirement": np.asarray(reference_labels, dtype=object)[most_similar_indices],
+            "Similarity": similarities[np.arange(len(self.labels)), most_similar_indices],
+        })
+
+# This function stacks one or several embeddings into a L2-normalized float32 matrix (with no rows for an empty list)
+def to_normalized_matrix(embeddings):
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[np.newaxis, :] if matrix.size else matrix.reshape(0, 0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)  # Avoid dividing by zero
+
 # this function ranks the solutions by the similarity their embeddings have with a given one (design goal or a specific requirement)
-def rank_by_similarity(reference_embedding, embeddings, labels):
-    similarities = cosine_similarity([reference_embedding], embeddings)[0]
-    ranked = sorted(zip(labels, similarities), key=lambda x: x[1], reverse=True)
-    df = pd.DataFrame(ranked, columns=["Solution", "Similarity"])
+def rank_by_similarity(reference_embedding, similarity_engine, top_k=None):
+    df = similarity_engine.rank(reference_embedding, top_k=top_k)
     st.dataframe(df, use_container_width=True)  # Display ranked table
     return df
 
+# This class is an approximate nearest neighbour index (IVF, inverted file lists) over all the solutions generated across projects, so past solutions similar to a new one can be found without comparing it with the whole history
+# The normalized vectors are appended to a float32 file that is memory-mapped when searching, each vector is assigned to its closest k-means centroid and only the lists of the n_probe closest centroids are compared with the query
+# Until the index holds enough vectors to train the centroids the search is exact (brute force over the memory-mapped vectors)
+class SolutionIndex:
+    def __init__(self, directory, n_lists=128, n_probe=8, min_train_size=None):
+        self.directory = directory
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.min_train_size = min_train_size or 40 * n_lists  # Enough vectors per list to get meaningful centroids
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.assignments_path = os.path.join(directory, "assignments.i32")
+        self.centroids_path = os.path.join(directory, "centroids.npy")
+        self.metadata_path = os.path.join(directory, "metadata.jsonl")
+        self.info_path = os.path.join(directory, "index.json")
+
+        # Load the index information, the metadata of the stored solutions and the vectors, keeping only the committed solutions
+        self.dimensions = None
+        self.count = None
+        if os.path.exists(self.info_path):
+            with open(self.info_path, "r") as file:
+                info = json.load(file)
+            self.dimensions = info["dimensions"]
+            self.count = info.get("count")  # Indexes written by older versions do not store it
+        self.metadata = self.read_metadata()
+        self.centroids = np.load(self.centroids_path) if os.path.exists(self.centroids_path) else None
+        self.reconcile()
+        self.keys = {(entry["category"], entry["text"]) for entry in self.metadata}
+
+    # This function reads the metadata lines of the stored solutions, stopping at a partially written line
+    # It also keeps the size of the lines read, so the lines that were not committed can be removed from the file
+    def read_metadata(self):
+        metadata = []
+        self.metadata_sizes = []
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, "rb") as file:
+                for line in file:
+                    if (self.count is not None and len(metadata) >= self.count) or not line.endswith(b"\n"):
+                        break
+                    try:
+                        metadata.append(json.loads(line))
+                    except ValueError:
+                        break
+                    self.metadata_sizes.append(len(line))
+        return metadata
+
+    # This function brings the files back to the committed number of solutions (the count stored in index.json, or the shortest of the files for older indexes)
+    # The vectors, assignments and metadata are appended one after the other and the count is only updated once all of them are written, so an interrupted or failed insert leaves extra rows that are removed here
+    def reconcile(self):
+        vector_bytes = 4 * self.dimensions if self.dimensions else 0
+        stored_vectors = os.path.getsize(self.vectors_path) // vector_bytes if vector_bytes and os.path.exists(self.vectors_path) else 0
+        count = min(stored_vectors, len(self.metadata)) if self.count is None else min(self.count, stored_vectors, len(self.metadata))
+        if vector_bytes and os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != count * vector_bytes:
+            os.truncate(self.vectors_path, count * vector_bytes)
+        self.metadata = self.metadata[:count]
+        self.metadata_sizes = self.metadata_sizes[:count]
+        if os.path.exists(self.metadata_path) and os.path.getsize(self.metadata_path) != sum(self.metadata_sizes):
+            os.truncate(self.metadata_path, sum(self.metadata_sizes))
+        if self.dimensions and self.count != count:
+            self.write_info(count)
+        self.count = count
+
+        # Each vector must have its list assignment, otherwise the centroids are trained again (an interrupted training or insert)
+        stored_assignments = os.path.getsize(self.assignments_path) // 4 if os.path.exists(self.assignments_path) else 0
+        if self.centroids is not None and stored_assignments > count:
+            os.truncate(self.assignments_path, count * 4)
+        retrain = self.centroids is not None and stored_assignments < count
+        if retrain:
+            self.centroids = None
+            os.remove(self.centroids_path)
+        self.load_vectors()
+        if retrain and len(self) >= self.min_train_size:
+            self.train()
+
+    # This function stores the dimensions and the committed number of solutions of the index, the file is written to a temporary name and renamed so it is replaced atomically
+    def write_info(self, count):
+        temporary_path = f"{self.info_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"dimensions": self.dimensions, "count": count}, file)
+        os.replace(temporary_path, self.info_path)
+
+    # This function memory-maps the stored vectors and their list assignments
+    def load_vectors(self):
+        self.vectors = None
+        self.assignments = None
+        if self.dimensions and self.count and os.path.exists(self.vectors_path):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dimensions))
+        if self.centroids is not None and self.count and os.path.exists(self.assignments_path):
+            self.assignments = np.memmap(self.assignments_path, dtype=np.int32, mode="r", shape=(self.count,))
+        self.inverted_lists = None  # Rebuilt on the next search
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    # This function appends new solutions to the index, skipping the (category, text) pairs that are already stored
+    def insert(self, embeddings, texts, category, design_problem=None):
+        with self.lock:
+            new_vectors = []
+            new_metadata = []
+            new_keys = set()
+            for embedding, text in zip(embeddings, texts):
+                if embedding is None or (category, text) in self.keys or (category, text) in new_keys:
+                    continue
+                new_keys.add((category, text))
+                new_vectors.append(embedding)
+                new_metadata.append({"text": text, "category": category, "design_problem": design_problem})
+            if not new_vectors:
+                return 0
+
+            new_vectors = to_normalized_matrix(new_vectors)
+            if self.dimensions is None:
+                self.dimensions = new_vectors.shape[1]
+            elif new_vectors.shape[1] != self.dimensions:
+                raise ValueError(f"The index stores {self.dimensions}-dimensional embeddings, got {new_vectors.shape[1]}.")
+
+            # Append the vectors, their list assignments and their metadata to the files, the new solutions are only committed when the count is updated after all of them
+            try:
+                with open(self.vectors_path, "ab") as file:
+                    file.write(new_vectors.tobytes())
+                if self.centroids is not None:
+                    with open(self.assignments_path, "ab") as file:
+                        file.write(self.assign(new_vectors).tobytes())
+                new_lines = [(json.dumps(entry) + "\n").encode("utf-8") for entry in new_metadata]
+                with open(self.metadata_path, "ab") as file:
+                    file.write(b"".join(new_lines))
+                self.write_info(self.count + len(new_vectors))
+            except Exception:
+                self.reconcile()  # Remove the rows that were written before the error
+                raise
+            self.count += len(new_vectors)
+            self.metadata.extend(new_metadata)
+            self.metadata_sizes.extend(len(line) for line in new_lines)
+            self.keys.update(new_keys)
+            self.load_vectors()
+
+            # Train the centroids once there are enough vectors
+            if self.centroids is None and len(self) >= self.min_train_size:
+                self.train()
+            return len(new_vectors)
+
+    # This function trains the list centroids with spherical k-means and assigns all the stored vectors to them
+    # The assignments are replaced before the centroids are saved, so an interrupted training never leaves centroids with the assignments of other centroids
+    def train(self, n_iterations=20, sample_size=50000):
+        rng = np.random.default_rng(42)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(len(self), size=min(sample_size, len(self)), replace=False))])
+        centroids = sample[rng.choice(len(sample), size=self.n_lists, replace=False)]
+        for _ in range(n_iterations):
+            labels = (sample @ centroids.T).argmax(axis=1)
+            for list_id in range(self.n_lists):
+                members = sample[labels == list_id]
+                if len(members):
+                    centroids[list_id] = members.mean(axis=0)
+            centroids = to_normalized_matrix(centroids)
+        self.centroids = centroids
+        temporary_path = f"{self.assignments_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            for start in range(0, len(self), 65536):
+                file.write(self.assign(np.asarray(self.vectors[start:start + 65536])).tobytes())
+        os.replace(temporary_path, self.assignments_path)
+        with open(f"{self.centroids_path}.{os.getpid()}.tmp", "wb") as file:
+            np.save(file, centroids)
+        os.replace(f"{self.centroids_path}.{os.getpid()}.tmp", self.centroids_path)
+        self.load_vectors()
+
+    # This function returns the closest centroid of each vector
+    def assign(self, vectors):
+        return (vectors @ self.centroids.T).argmax(axis=1).astype(np.int32)
+
+    # This function returns a DataFrame with the k stored solutions most similar to the query embedding
+    def search(self, query_embedding, k=10, category=None):
+        with self.lock:
+            if not len(self):
+                return pd.DataFrame(columns=["Solution", "Category", "Design Problem", "Similarity"])
+            query = to_normalized_matrix(query_embedding)[0]
+            if self.assignments is None:
+                # Exact search over all the vectors, in chunks to keep the memory bounded
+                candidates = np.arange(len(self))
+                scores = np.concatenate([np.asarray(self.vectors[start:start + 65536]) @ query for start in range(0, len(self), 65536)])
+            else:
+                if self.inverted_lists is None:
+                    order = np.argsort(self.assignments, kind="stable")
+                    offsets = np.searchsorted(self.assignments[order], np.arange(self.n_lists + 1))
+                    self.inverted_lists = (order, offsets)
+                order, offsets = self.inverted_lists
+                probed_lists = np.argsort(-(self.centroids @ query))[:self.n_probe]
+                candidates = np.sort(np.concatenate([order[offsets[list_id]:offsets[list_id + 1]] for list_id in probed_lists]))
+                scores = np.asarray(self.vectors[candidates]) @ query
+
+            # Restrict the results to the given category
+            if category is not None:
+                in_category = np.array([self.metadata[i]["category"] == category for i in candidates], dtype=bool)
+                candidates = candidates[in_category]
+                scores = scores[in_category]
+
+            k = min(k, len(candidates))
+            if k == 0:
+                return pd.DataFrame(columns=["Solution", "Category", "Design Problem", "Similarity"])
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            return pd.DataFrame({
+                "Solution": [self.metadata[candidates[i]]["text"] for i in top],
+                "Category": [self.metadata[candidates[i]]["category"] for i in top],
+                "Design Problem": [self.metadata[candidates[i]]["design_problem"] for i in top],
+                "Similarity": scores[top],
+            })
+
+# Define where the solutions index is stored (an empty path disables it)
+SOLUTION_INDEX_DIRECTORY = os.environ.get("XAI_APP_SOLUTION_INDEX", "solution_index")
+
+# The indexes are created once per server process (one per embeddings backend, since their dimensions differ) and shared by all the sessions
+solution_indexes = {}
+solution_indexes_lock = threading.Lock()
+
+# This function returns the solutions index of an embeddings backend, creating it the first time it is needed (None if it is disabled)
+def get_solution_index(backend=None):
+    if not SOLUTION_INDEX_DIRECTORY:
+        return None
+    backend = backend or get_embedding_backend()
+    with solution_indexes_lock:
+        if backend.name not in solution_indexes:
+            directory_name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{backend.name}_{backend.dimensions or 'default'}")
+            solution_indexes[backend.name] = SolutionIndex(os.path.join(SOLUTION_INDEX_DIRECTORY, directory_name))
+        return solution_indexes[backend.name]
+
 # This function normalizes embeddings to assure consistency when calculating distances or similarities
 def normalize_embeddings(embeddings):
     return [embedding / np.linalg.norm(embedding) for embedding in embeddings]
@@ -225,33 +1070,345 @@ def normalize_embeddings(embeddings):
 # 3. CONVERGENT THINKING FUNCTIONS
 
 # 4. FINAL RESULTS FUNCTIONS
+
+# MASKED LM REGISTRY
+# Masked language models that can generate the ReAgent perturbations, the distilled model is about twice as fast as roberta-base (half of the layers) with slightly less fluent predictions and the large one is slower with more fluent ones
+# Any other Hugging Face checkpoint name or local checkpoint directory can also be used as the model name
+MASKED_LM_MODELS = {
+    "roberta-base": "roberta-base",
+    "distilroberta": "distilroberta-base",
+    "roberta-large": "roberta-large",
+}
+
+# Define the masked language model used to generate the ReAgent perturbations, the backend that runs it and its number of CPU threads
+MASKED_LM_NAME = os.environ.get("XAI_APP_MASKED_LM", "roberta-base")
+MASKED_LM_BACKEND = os.environ.get("XAI_APP_MASKED_LM_BACKEND", "eager")
+MASKED_LM_THREADS = int(os.environ.get("XAI_APP_MASKED_LM_THREADS", 0))  # 0 keeps the PyTorch default (one thread per core), for the PyTorch backends it applies to the whole process (see set_torch_threads)
+MASKED_LM_EXPORT_DIRECTORY = os.environ.get("XAI_APP_MASKED_LM_EXPORT", "masked_lm_export")  # Where the exported ONNX graphs are kept between server restarts
+
+# MASKED LM INFERENCE BACKENDS
+# Every backend wraps a loaded transformers masked LM and has a name (used in the predictions cache key, since the backends may predict slightly different tokens), the model config, a logits(input_ids) method and a memory_bytes() method
+# This backend runs the float32 model in PyTorch eager mode
+class EagerMaskedLMBackend:
+    backend_name = "eager"
+
+    def __init__(self, model, threads=MASKED_LM_THREADS):
+        self.config = model.config
+        self.name = f"{model.config.name_or_path}:{self.backend_name}"
+        self.model = self.prepare(model, threads)
+
+    # This method converts the loaded model into the one run by the backend
+    def prepare(self, model, threads):
+        return model
+
+    # This method returns the logits of a batch of input ids
+    def logits(self, input_ids):
+        import torch
+        with torch.no_grad():
+            return self.model(input_ids).logits
+
+    # This method returns the memory used by the model weights
+    def memory_bytes(self):
+        return state_dict_bytes(self.model.state_dict().values())
+
+# This backend quantizes the weights of the linear layers to int8 (dynamic quantization, the activations are quantized on the fly), it uses about a third of the memory and is faster on CPU
+class QuantizedMaskedLMBackend(EagerMaskedLMBackend):
+    backend_name = "quantized"
+
+    def prepare(self, model, threads):
+        import torch
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+# This backend traces the model into a frozen TorchScript graph, which removes the Python overhead of the eager forward pass
+class TorchScriptMaskedLMBackend(EagerMaskedLMBackend):
+    backend_name = "torchscript"
+
+    def prepare(self, model, threads):
+        import torch
+        example_input_ids = torch.zeros((2, 16), dtype=torch.long)  # The traced graph accepts any batch size and sequence length
+        with torch.no_grad():
+            traced_model = torch.jit.trace(model, (example_input_ids,), strict=False)
+        self.weights_bytes = state_dict_bytes(model.state_dict().values())  # The frozen graph keeps the weights as constants
+        return torch.jit.freeze(traced_model.eval())
+
+    def logits(self, input_ids):
+        import torch
+        with torch.no_grad():
+            return self.model(input_ids)["logits"]
+
+    def memory_bytes(self):
+        return self.weights_bytes
+
+# This backend exports the model to ONNX and runs it with ONNX Runtime (optional dependency), the exported graph is kept on disk and reused by the next server processes
+class OnnxMaskedLMBackend(EagerMaskedLMBackend):
+    backend_name = "onnx"
+
+    def prepare(self, model, threads):
+        import inspect
+        import torch
+        import onnxruntime
+
+        self.path = os.path.join(MASKED_LM_EXPORT_DIRECTORY, f"{model.config.name_or_path.replace('/', '_')}.onnx")
+        if not os.path.exists(self.path):
+            os.makedirs(MASKED_LM_EXPORT_DIRECTORY, exist_ok=True)
+            export_options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}  # Newer PyTorch versions default to the dynamo exporter
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            torch.onnx.export(
+                model, (torch.zeros((2, 16), dtype=torch.long),), temporary_path,
+                input_names=["input_ids"], output_names=["logits"],
+                dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "logits": {0: "batch", 1: "sequence"}},
+                opset_version=14, **export_options,
+            )
+            os.replace(temporary_path, self.path)  # Atomic, so concurrent server processes never load a partial file
+
+        session_options = onnxruntime.SessionOptions()
+        if threads > 0:
+            session_options.intra_op_num_threads = threads
+        return onnxruntime.InferenceSession(self.path, session_options, providers=["CPUExecutionProvider"])
+
+    def logits(self, input_ids):
+        import torch
+        return torch.from_numpy(self.model.run(["logits"], {"input_ids": input_ids.numpy()})[0])
+
+    def memory_bytes(self):
+        return os.path.getsize(self.path)
+
+# Define the available masked LM backends
+MASKED_LM_BACKENDS = {
+    "eager": EagerMaskedLMBackend,
+    "quantized": QuantizedMaskedLMBackend,
+    "torchscript": TorchScriptMaskedLMBackend,
+    "onnx": OnnxMaskedLMBackend,
+}
+
+# This function wraps a loaded masked LM with the selected backend
+def create_masked_lm_backend(model, backend_name=None, threads=MASKED_LM_THREADS):
+    backend_name = backend_name or MASKED_LM_BACKEND
+    if backend_name not in MASKED_LM_BACKENDS:
+        raise ValueError(f"Unknown masked LM backend '{backend_name}', use one of: {', '.join(MASKED_LM_BACKENDS)}.")
+    return MASKED_LM_BACKENDS[backend_name](model, threads)
+
+# This function sets the number of intra-op threads of PyTorch
+# The setting is global: it applies to the whole process (every masked LM, the local embeddings encoder and any other PyTorch model), so it is only set once when the first masked LM is loaded and not by each backend
+def set_torch_threads(threads=MASKED_LM_THREADS):
+    import torch
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+# This function returns the memory used by a list of tensors (the quantized layers store their weights in tuples)
+def state_dict_bytes(values):
+    import torch
+    total = 0
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            total += state_dict_bytes(value)
+    return total
+
+# This function returns the logits of a batch of input ids with a masked LM backend or a plain transformers model
+def masked_lm_logits(model, input_ids):
+    if isinstance(model, EagerMaskedLMBackend):
+        return model.logits(input_ids)
+    return model(input_ids).logits
+
+# The masked language models are loaded once per server process and shared read-only by all the sessions, the first caller (usually the background warm-up) loads them and the rest wait for it
+# The forward passes are serialized with an inference lock so concurrent sessions can use the same instances safely
+masked_lms = {}
+masked_lm_lock = threading.Lock()
+masked_lm_inference_lock = threading.Lock()
+
+# This function returns the tokenizer and masked language model (wrapped with the selected backend) of a registry name or checkpoint, loading them the first time they are needed
+def get_masked_lm(model_name=None):
+    model_name = model_name or MASKED_LM_NAME
+    with masked_lm_lock:
+        if model_name not in masked_lms:
+            from transformers import AutoTokenizer, AutoModelForMaskedLM
+            if not masked_lms:
+                set_torch_threads()  # Process-wide, set before the first model is loaded
+            checkpoint = MASKED_LM_MODELS.get(model_name, model_name)
+            tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+            model = AutoModelForMaskedLM.from_pretrained(checkpoint)
+            model.eval()  # Set the model to evaluation mode
+            masked_lms[model_name] = (tokenizer, create_masked_lm_backend(model))
+    return masked_lms[model_name]
+
+# This function returns the maximum number of tokens (special tokens included) that a masked LM accepts
+# The tokenizers of local checkpoints may not define it, so it is also bounded by the position embeddings of the model (RoBERTa-like models reserve the first positions for the padding)
+def masked_lm_max_length(tokenizer, model):
+    max_length = tokenizer.model_max_length
+    max_positions = getattr(model.config, "max_position_embeddings", None)
+    if max_positions is not None:
+        if model.config.model_type in ("roberta", "xlm-roberta", "camembert") and model.config.pad_token_id is not None:
+            max_positions -= model.config.pad_token_id + 1
+        max_length = min(max_length, max_positions)
+    return max_length
     
+# Define the model and generation parameters of the answers, since the answers are deterministic (temperature 0) they are cached keyed by them
+ANSWER_MODEL = "gpt-4o-mini" # Since the design process is almost done and we are just using this stage as a tool to understand the results we will use a fast model such as 4o-mini to ensure fast results
+ANSWER_PARAMETERS = {"max_tokens": 1, "temperature": 0, "logprobs": True, "top_logprobs": 5}
+
 # This function generates a Chat GPT4 answer and the first 5 logprobs for a given input
-def answer_generation(input, role_description):
+# The client can be given explicitly (background jobs and the headless pipeline do not have access to the session state), otherwise the one stored in the session state is used
+def answer_generation(input, role_description, client=None, callbacks=None):
+    client = get_client(client)
+    callbacks = get_callbacks(callbacks)
 
     # Check if the openai client can be accessed
-    if "client" not in st.session_state:
-        st.error("OpenAI client is not initialized. Please provide a valid API key.")
+    if client is None:
+        callbacks.error("OpenAI client is not initialized. Please provide a valid API key.")
         return None
 
     # Generate an answer if the openai client can be access
     try:
-        response = st.session_state.client.chat.completions.create(
-            model="gpt-4o-mini", # Since the design process is almost done and we are just using this stage as a tool to understand the results we will use a fast model such as 4o-mini to ensure fast results
+        response = client.chat_completion(
+            model=ANSWER_MODEL,
             messages=[
                 {"role": "system", "content": role_description},
                 {"role": "user", "content": input},
             ],
-            max_tokens=1,
-            temperature=0,
-            logprobs=True,
-            top_logprobs=5,
+            **ANSWER_PARAMETERS,
         )
         return response
     except Exception as e:
-        st.error(f"Error generating response: {e}")
+        callbacks.error(f"Error generating response: {e}")
         return None
 
+# Define where the shared answers cache is stored and how many answers it keeps (an empty path, the default, keeps the answers only in memory during each run)
+RESPONSE_CACHE_PATH = os.environ.get("XAI_APP_RESPONSE_CACHE", "")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("XAI_APP_RESPONSE_CACHE_MAX_ENTRIES", 100000))
+
+# This class stores the probs of the Chat GPT4 answers in an on-disk SQLite database keyed by the ResponseCache keys, it is shared by all the sessions of the server
+class ResponseDiskCache:
+    def __init__(self, path, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")  # Allow several server processes to read while one writes
+            self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, probs TEXT, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.connection.commit()
+
+    # This function returns a dictionary with the cached probs of the given keys, refreshing their last use to keep them from being evicted
+    def get_many(self, keys):
+        key_list = list(keys)
+        found = {}
+        with self.lock:
+            for start in range(0, len(key_list), 500):  # Stay below the SQLite variable limit
+                chunk = key_list[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, probs FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, probs in rows:
+                    found[key] = json.loads(probs)
+            if found:
+                now = time.time()
+                self.connection.executemany("UPDATE responses SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self.connection.commit()
+        return found
+
+    # This function stores a dictionary of probs and evicts the least recently used ones if the cache grows over its maximum size
+    def put_many(self, probs_by_key):
+        now = time.time()
+        rows = [(key, json.dumps(probs), now) for key, probs in probs_by_key.items()]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", rows)
+            count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self.connection.commit()
+
+# The disk cache is created once per server process and shared by all the sessions
+response_disk_cache = None
+response_disk_cache_lock = threading.Lock()
+
+# This function returns the shared answers disk cache, creating it the first time it is needed (None if it is disabled or cannot be opened)
+def get_response_disk_cache(callbacks=None):
+    global response_disk_cache
+    if not RESPONSE_CACHE_PATH:
+        return None
+    with response_disk_cache_lock:
+        if response_disk_cache is None:
+            try:
+                response_disk_cache = ResponseDiskCache(RESPONSE_CACHE_PATH)
+            except sqlite3.Error as e:
+                get_callbacks(callbacks).warning(f"The answers cache could not be opened, answers will only be cached during each run: {e}")
+                return None
+    return response_disk_cache
+
+# This class memoizes the probs of the Chat GPT4 answers keyed by (model, role, input, parameters), so identical prompts (perturbations that regenerate a previous text or repeated retries) are only paid once
+# The answers are kept in memory for the run and in the shared disk cache if it is enabled, the hits and misses are counted to report the API calls used
+class ResponseCache:
+    def __init__(self, disk_cache=None):
+        self.memory = {}
+        self.disk_cache = disk_cache
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # This function builds the content address of a prompt
+    @staticmethod
+    def make_key(model, role_description, text, parameters):
+        return hashlib.sha256(json.dumps([model, role_description, text, parameters], sort_keys=True).encode("utf-8")).hexdigest()
+
+    # This method returns a dictionary with the cached probs of the given keys, looking in memory first and then on disk
+    def get_many(self, keys):
+        with self.lock:
+            found = {key: self.memory[key] for key in keys if key in self.memory}
+        missing = [key for key in keys if key not in found]
+        if missing and self.disk_cache is not None:
+            from_disk = self.disk_cache.get_many(missing)
+            with self.lock:
+                self.memory.update(from_disk)
+            found.update(from_disk)
+        return found
+
+    # This method stores a dictionary of probs in memory and on disk
+    def put_many(self, probs_by_key):
+        with self.lock:
+            self.memory.update(probs_by_key)
+        if self.disk_cache is not None and probs_by_key:
+            self.disk_cache.put_many(probs_by_key)
+
+    # This method counts the answers taken from the cache and the ones generated
+    def record(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+# Number of ReAgent iterations whose Chat GPT4 answers are generated concurrently (1 runs the original sequential loop)
+REAGENT_WINDOW = int(os.environ.get("XAI_APP_REAGENT_WINDOW", 5))
+
+# This function generates the Chat GPT4 answers of several inputs concurrently and returns their probs in the same order as the inputs
+# If a response cache is given the cached answers are reused and each missing prompt is generated only once, even if it is repeated in the inputs
+def generate_probs_concurrently(inputs, role_description, max_workers=REAGENT_WINDOW, response_cache=None, client=None, callbacks=None):
+    client = get_client(client)
+    callbacks = get_callbacks(callbacks)
+    def generate_probs(text):
+        return extract_probs_information(answer_generation(text, role_description, client, callbacks))
+
+    if response_cache is not None:
+        keys = [response_cache.make_key(ANSWER_MODEL, role_description, text, ANSWER_PARAMETERS) for text in inputs]
+        probs_by_key = response_cache.get_many(set(keys))
+        missing = {key: text for key, text in zip(keys, inputs) if key not in probs_by_key}
+        new_probs = dict(zip(missing, generate_probs_concurrently(list(missing.values()), role_description, max_workers, client=client, callbacks=callbacks)))
+        response_cache.put_many(new_probs)
+        response_cache.record(hits=len(inputs) - len(missing), misses=len(missing))
+        probs_by_key.update(new_probs)
+        return [probs_by_key[key] for key in keys]
+
+    if max_workers <= 1 or len(inputs) <= 1:
+        return [generate_probs(text) for text in inputs]
+
+    # Attach the Streamlit script context (if the function is called from a page) to the worker threads so they can display errors
+    ctx = get_script_run_ctx(suppress_warning=True)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(inputs)), initializer=attach_script_run_ctx, initargs=(ctx,)) as executor:
+        return list(executor.map(generate_probs, inputs))
+
 # This function takes an output with logprobs values from ChatGPT4 and returns the ordered values of probs and token (is used to handle data easier and to work with probs instead of logprobs as expected in the ReAgent method)
 def extract_probs_information(response):
     """
@@ -292,37 +1449,106 @@ def extract_probs_information(response):
 
 # This function subtitute a defined percentage of the tokens randomly of a given text with RoBERTa predictions
 def substitute_tokens(input_ids, num_tokens, replace_ratio, tokenizer, model):
+    # Randomly select token indices to mask and predict them with RoBERTa
+    mask_indices = draw_perturbation_masks(num_tokens, replace_ratio, 1)[0]
+    substituted_text = substitute_tokens_batch(input_ids, [mask_indices], tokenizer, model)[0]
+    return substituted_text, mask_indices
 
-    # Clone input_ids to avoid modifying the original tensor
-    input_ids_for_modification = input_ids.clone()
-    
+# This function draws the random token indices to mask for several perturbations at once, since they do not depend on the LLM responses all the ReAgent iterations can be drawn up front
+# The indices are drawn from the given random generator (the global random state by default)
+def draw_perturbation_masks(num_tokens, replace_ratio, num_perturbations, rng=random):
     num_tokens_to_mask = max(1, int(num_tokens * replace_ratio)) # Define the number of tokens to mask (the ones that will be substituted with RoBERTa generated solutions) according to the replace ratio
-
-    # Randomly select token indices to mask
-    mask_indices = random.sample(range(0, num_tokens), num_tokens_to_mask)
-    
-    # Replace selected tokens with <mask>
-    for idx in mask_indices:
-        input_ids_for_modification[idx] = tokenizer.mask_token_id
-    
-    # Predict all masks simultaneously
-    with torch.no_grad():
-        outputs = model(input_ids_for_modification.unsqueeze(0))  # Add batch dimension
-        logits = outputs.logits
-    
-    # Decode predictions for each <mask>
-    for mask_idx in mask_indices:
-        # Get the logits for the current <mask>
-        mask_logits = logits[0, mask_idx, :]
-        predicted_token_id = torch.argmax(mask_logits).item()
-        
-        # Replace the mask token with the predicted token
-        input_ids_for_modification[mask_idx] = predicted_token_id
-    
-    # Decode the final sequence
-    substituted_text = tokenizer.decode(input_ids_for_modification, skip_special_tokens=True)
-    
-    return substituted_text, mask_indices
+    return [rng.sample(range(0, num_tokens), num_tokens_to_mask) for _ in range(num_perturbations)]
+
+# Maximum number of logits computed in a single forward pass (sequences x tokens x vocabulary), it bounds the memory of the batched predictions (2**25 float32 values are 128 MB)
+MAX_BATCH_LOGITS = 2 ** 25
+
+# Define how many masked LM predictions are kept in memory
+MASKED_LM_CACHE_MAX_ENTRIES = int(os.environ.get("XAI_APP_MASKED_LM_CACHE_MAX_ENTRIES", 50000))
+
+# This class keeps the masked LM predictions keyed by (model, token ids, masked positions) in a least recently used memory cache shared by all the sessions of the server
+# All the explanations of a design problem share the same prompt template, so the same masked inputs are predicted again across iterations, explanations and stopping condition checks
+class MaskedLMCache:
+    def __init__(self, max_entries=MASKED_LM_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # This function builds the content address of a masked input (the predictions do not depend on the order of the masked positions)
+    @staticmethod
+    def make_key(model, input_ids, mask_indices):
+        positions = sorted(int(idx) for idx in mask_indices)
+        model_name = model.name if isinstance(model, EagerMaskedLMBackend) else model.config.name_or_path
+        content = f"{model_name}\x1f{positions}\x1f".encode("utf-8") + input_ids.numpy().tobytes()
+        return hashlib.sha256(content).digest()
+
+    # This method returns a dictionary with the cached predictions of the given keys
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    # This method stores a dictionary of predictions and evicts the least recently used ones
+    def put_many(self, predictions_by_key):
+        with self.lock:
+            self.entries.update(predictions_by_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+# The cache is created once per server process and shared by all the sessions
+masked_lm_cache = MaskedLMCache()
+
+# This function substitutes the given masks of several copies of the same input with RoBERTa predictions, all the copies are predicted together in batched forward passes
+# The predictions of the masked inputs already seen are taken from the cache and each missing one is predicted only once
+def substitute_tokens_batch(input_ids, masks_list, tokenizer, model):
+    keys = [masked_lm_cache.make_key(model, input_ids, mask_indices) for mask_indices in masks_list]
+    predictions_by_key = masked_lm_cache.get_many(keys)
+    missing = {key: sorted(int(idx) for idx in mask_indices) for key, mask_indices in zip(keys, masks_list) if key not in predictions_by_key}
+    if missing:
+        new_predictions = dict(zip(missing, predict_masked_tokens(input_ids, list(missing.values()), tokenizer, model)))
+        masked_lm_cache.put_many(new_predictions)
+        predictions_by_key.update(new_predictions)
+
+    # Replace the masked tokens of each copy of the input with the predicted tokens and decode the final sequences
+    batch_input_ids = input_ids.unsqueeze(0).repeat(len(masks_list), 1)
+    for row, (key, mask_indices) in enumerate(zip(keys, masks_list)):
+        batch_input_ids[row, sorted(int(idx) for idx in mask_indices)] = input_ids.new_tensor(predictions_by_key[key])
+    return tokenizer.batch_decode(batch_input_ids, skip_special_tokens=True)
+
+# This function predicts the masked tokens of several copies of the same input with RoBERTa in batched forward passes, it returns the predicted token ids of each copy in the order of its masked positions
+def predict_masked_tokens(input_ids, masks_list, tokenizer, model):
+    import torch
+
+    # Build one copy of the input per perturbation and replace its selected tokens with <mask>
+    batch_input_ids = input_ids.unsqueeze(0).repeat(len(masks_list), 1)
+    rows = torch.tensor([row for row, mask_indices in enumerate(masks_list) for _ in mask_indices], dtype=torch.long)
+    columns = torch.tensor([idx for mask_indices in masks_list for idx in mask_indices], dtype=torch.long)
+    batch_input_ids[rows, columns] = tokenizer.mask_token_id
+
+    # Predict all masks simultaneously, in as many sequences per forward pass as the logits memory bound allows
+    sequences_per_pass = max(1, MAX_BATCH_LOGITS // (batch_input_ids.shape[1] * model.config.vocab_size))
+    predicted_token_ids = torch.empty(len(rows), dtype=torch.long)
+    for start in range(0, len(masks_list), sequences_per_pass):
+        in_pass = (rows >= start) & (rows < start + sequences_per_pass)
+        with masked_lm_inference_lock, torch.no_grad():
+            logits = masked_lm_logits(model, batch_input_ids[start:start + sequences_per_pass])
+        predicted_token_ids[in_pass] = torch.argmax(logits[rows[in_pass] - start, columns[in_pass], :], dim=-1)
+
+    # Split the predicted tokens by copy
+    predicted_token_ids = predicted_token_ids.tolist()
+    predictions = []
+    for mask_indices in masks_list:
+        predictions.append(tuple(predicted_token_ids[:len(mask_indices)]))
+        predicted_token_ids = predicted_token_ids[len(mask_indices):]
+    return predictions
 
 # This function takes to lists of probs and checks the probability change for the first token of the first list
 def calculate_prob_difference(original_probs, modified_probs):
@@ -379,56 +1605,72 @@ def visualize_scores(tokens, normalized_scores):
 
     return html_output
 
+# This function returns the ReAgent logit of a scaled probability difference, with an epsilon correction for the extreme value that would divide by zero
+# As in the original loop, a scaled difference of -1 (log of 0) raises a math domain error
+def reagent_logit(scaled_diff):
+    logit_term = (scaled_diff + 1) / 2
+    if (1 - logit_term) == 0: # Handle ZeroDivision Errors
+        epsilon = 1e-10
+        return math.log((logit_term+epsilon)/(1-logit_term+epsilon))
+    return math.log(logit_term/(1-logit_term))
+
+# This function calculates the ReAgent logit update of all the tokens at once
+# The scaled difference is positive for the replaced tokens and negative for the rest, so only two logits are computed and spread with the replaced tokens mask, the updates are weighted so the total importance does not vary
+# Each logit is only computed if some updated token uses it, so the errors are the same as in the original per-token loop
+def calculate_logit_update(scaled_diff, replaced_mask, updated_mask, replace_ratio):
+    scaled_probs_diff_vect = np.where(updated_mask, np.where(replaced_mask, scaled_diff, -scaled_diff), 0.0)
+    logit_update = np.zeros(len(updated_mask))
+    if np.any(updated_mask & replaced_mask):
+        logit_update[updated_mask & replaced_mask] = (1 - replace_ratio) * reagent_logit(scaled_diff)
+    if np.any(updated_mask & ~replaced_mask):
+        logit_update[updated_mask & ~replaced_mask] = replace_ratio * reagent_logit(-scaled_diff)
+    return scaled_probs_diff_vect, logit_update
+
 # This function cleans up LLM-generated tokens for visualization purposes
-def clean_tokens(tokens):
+# The word markers of the byte-level BPE (RoBERTa), SentencePiece and WordPiece (BERT) tokenizers are removed, if the tokenizer is given its special tokens are kept as they are
+def clean_tokens(tokens, tokenizer=None):
+    special_tokens = set(tokenizer.all_special_tokens) if tokenizer is not None else set()
     cleaned_tokens = []
     for token in tokens:
+        if token in special_tokens:
+            cleaned_tokens.append(token)
+            continue
         token = unicodedata.normalize("NFKC", token) # Normalize the token to handle any encoding issues
         token = token.strip() # Strip any surrounding whitespace
         token = token.replace("Ċ", " ") # Clean up blank space
         token = token.replace("Ġ", "") # Clean up word beginnings
+        token = token.replace("▁", "") # Clean up SentencePiece word beginnings
+        if token.startswith("##") and len(token) > 2:
+            token = token[2:] # Clean up WordPiece word continuations
         cleaned_tokens.append(token)
         
     return cleaned_tokens
 
 # This function checks if the stopping condition for the token importance calculation is met
 def calculate_stopping_condition(input_ids, num_tokens, replace_ratio, token_scores, original_probs, role_description, tokenizer, model):
-    # Set the stopping condition as false
-    stopping_condition = False
+    substituted_text = build_stopping_input(input_ids, num_tokens, replace_ratio, token_scores, tokenizer, model)
 
-    # Clone input_ids to avoid modifying the original tensor
-    input_ids_for_stopping = input_ids.clone()
+    # Generate predictions for the modified input
+    modified_probs = extract_probs_information(answer_generation(substituted_text, role_description))
+    return is_stopping_condition_met(original_probs, modified_probs)
 
+# This function substitutes the least important tokens of the input with RoBERTa predictions to check the stopping condition (it does not need the LLM, so the inputs of several iterations can be built before scoring them)
+def build_stopping_input(input_ids, num_tokens, replace_ratio, token_scores, tokenizer, model):
     # Calculate the number of tokens to replace (70% of the sequence)
     num_tokens_to_mask = int(replace_ratio * (num_tokens-2)) # We substract 2 to avoid <s> and </s>
 
     # Get indices of the 70% least important tokens
     mask_indices = np.argsort(token_scores)[:num_tokens_to_mask]
     
-    # Replace selected tokens with <mask>
-    for idx in mask_indices:
-        input_ids_for_stopping[idx] = tokenizer.mask_token_id
-    
-    # Predict all masks simultaneously
-    with torch.no_grad():
-        outputs = model(input_ids_for_stopping.unsqueeze(0))  # Add batch dimension
-        logits = outputs.logits
-    
-    # Decode predictions for each <mask>
-    for mask_idx in mask_indices:
-        # Get the logits for the current <mask>
-        mask_logits = logits[0, mask_idx, :]
-        predicted_token_id = torch.argmax(mask_logits).item()
-        
-        # Replace the mask token with the predicted token
-        input_ids_for_stopping[mask_idx] = predicted_token_id
-    
-    # Decode the final sequence
-    substituted_text = tokenizer.decode(input_ids_for_stopping, skip_special_tokens=True)
+    # Replace selected tokens with <mask>, predict all masks simultaneously (or take them from the cache if this masked input was already predicted) and decode the final sequence
+    substituted_text = substitute_tokens_batch(input_ids, [mask_indices.tolist()], tokenizer, model)[0]
     #st.write("Substituted text: ", substituted_text)
+    return substituted_text
 
-    # Generate predictions for the modified input
-    modified_probs = extract_probs_information(answer_generation(substituted_text, role_description))
+# This function checks if the original target token is still in the top-3 predictions of the input built by build_stopping_input
+def is_stopping_condition_met(original_probs, modified_probs):
+    # Set the stopping condition as false
+    stopping_condition = False
 
     # Check if the original target token is in the top-3 predictions
     original_token = original_probs[0][0]['token'].lower()
@@ -442,14 +1684,226 @@ def calculate_stopping_condition(input_ids, num_tokens, replace_ratio, token_sco
 
     return stopping_condition
 
+# This class is the default ReAgent convergence policy, the stopping condition (one RoBERTa pass and one API call) is only checked once the minimum number of iterations is reached, and then every "interval" iterations
+class ConvergencePolicy:
+    name = "every"
+    uses_stopping_condition = True  # Whether the policy checks the LLM stopping condition or decides the convergence locally
+
+    def __init__(self, min_iterations=10, interval=1):
+        self.min_iterations = min_iterations
+        self.interval = max(1, interval)
+
+    # This method returns True if the stopping condition must be checked after the given iteration
+    def should_check(self, iteration):
+        return iteration > self.min_iterations and (iteration - self.min_iterations - 1) % self.interval == 0
+
+    # This method returns True if the scores have converged without checking the stopping condition
+    def has_converged(self, historical_token_scores_normalized, iteration):
+        return False
+
+# This policy checks the stopping condition with exponentially growing spacing after the minimum number of iterations (1, 2, 4, 8... iterations after it)
+class BackoffConvergencePolicy(ConvergencePolicy):
+    name = "backoff"
+
+    def should_check(self, iteration):
+        offset = iteration - self.min_iterations
+        return offset > 0 and (offset & (offset - 1)) == 0
+
+# This policy does not use the LLM to decide the convergence, the scores have converged once the ranking of the "top_k" most important tokens has not changed in the last "patience" iterations
+class RankingStabilityConvergencePolicy(ConvergencePolicy):
+    name = "ranking"
+    uses_stopping_condition = False
+
+    def __init__(self, min_iterations=10, top_k=5, patience=3):
+        super().__init__(min_iterations)
+        self.top_k = top_k
+        self.patience = patience
+
+    def should_check(self, iteration):
+        return False
+
+    def has_converged(self, historical_token_scores_normalized, iteration):
+        if iteration <= self.min_iterations or iteration < self.patience:
+            return False
+        # Compare the top_k ranking after this iteration with the ones of the previous "patience" iterations (the historical scores are stored after each iteration, so iteration i ends in historical[i+1])
+        rankings = [tuple(np.argsort(-np.asarray(historical_token_scores_normalized[i + 1]), kind="stable")[:self.top_k]) for i in range(iteration - self.patience, iteration + 1)]
+        return len(set(rankings)) == 1
+
+# Define the available convergence policies and the one used by default
+CONVERGENCE_POLICIES = {
+    "every": ConvergencePolicy,
+    "backoff": BackoffConvergencePolicy,
+    "ranking": RankingStabilityConvergencePolicy,
+}
+REAGENT_CONVERGENCE_POLICY = os.environ.get("XAI_APP_REAGENT_CONVERGENCE", "every")
+
+# This function creates a convergence policy from its name and parameters
+def get_convergence_policy(policy_name=None, **parameters):
+    policy_name = policy_name or REAGENT_CONVERGENCE_POLICY
+    if policy_name not in CONVERGENCE_POLICIES:
+        raise ValueError(f"Unknown convergence policy '{policy_name}', use one of: {', '.join(CONVERGENCE_POLICIES)}.")
+    return CONVERGENCE_POLICIES[policy_name](**parameters)
+
+# This class is a compact trace of a ReAgent run, it can be saved to analyze the convergence offline or to visualize the run again without repeating the API calls
+# The per-iteration values are stored in column arrays and the texts (modified inputs and answer tokens) in a deduplicated string table referenced by index, the run-level values are kept in a JSON-serializable metadata dictionary
+class ReAgentTrace:
+    # Columns of the per-iteration table (see to_frame)
+    frame_columns = ["iteration", "modified_input", "replaced_indices", "prob_diff", "scaled_delta_p", "modified_tokens", "modified_probs", "logit_scores", "normalized_scores", "stopping_condition_met"]
+
+    def __init__(self, metadata=None, columns=None, strings=()):
+        self.metadata = metadata or {}
+        self.columns = columns or {}
+        self.strings = list(strings)
+        self.string_ids = {string: idx for idx, string in enumerate(self.strings)}
+        self.stopping_checks = []  # (iteration, stopping condition met) pairs recorded during the run
+
+    # This method creates an empty trace with room for the given number of iterations
+    @classmethod
+    def allocate(cls, max_iterations, num_tokens, num_alternatives=5):
+        return cls(columns={
+            "modified_input": np.full(max_iterations, -1, dtype=np.int32),  # Index of the modified input in the string table
+            "replaced_mask": np.zeros((max_iterations, num_tokens), dtype=bool),
+            "prob_diff": np.zeros(max_iterations),
+            "modified_tokens": np.full((max_iterations, num_alternatives), -1, dtype=np.int32),  # Indices of the top answer tokens in the string table (-1 if there are fewer alternatives)
+            "modified_probs": np.full((max_iterations, num_alternatives), np.nan),
+        })
+
+    # This method returns the index of a string in the string table, adding it the first time it is seen
+    def intern(self, string):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    # This method records the values of an iteration
+    def record_iteration(self, iteration, modified_input, replaced_mask, prob_diff, modified_probs):
+        self.columns["modified_input"][iteration] = self.intern(modified_input)
+        self.columns["replaced_mask"][iteration] = replaced_mask
+        self.columns["prob_diff"][iteration] = prob_diff
+        alternatives = modified_probs[0][:self.columns["modified_tokens"].shape[1]] if modified_probs else []
+        for k, alternative in enumerate(alternatives):
+            self.columns["modified_tokens"][iteration, k] = self.intern(alternative["token"])
+            self.columns["modified_probs"][iteration, k] = alternative["prob"]
+
+    # This method records the result of a stopping condition check
+    def record_stopping_check(self, iteration, stopping_condition_met):
+        self.stopping_checks.append((iteration, stopping_condition_met))
+
+    # This method trims the columns to the iterations kept by the run and adds the scores history (row 0 holds the initial scores) and the run-level values
+    def finish(self, iterations, historical_token_scores_logit, historical_token_scores_normalized, metadata):
+        for name in ("modified_input", "replaced_mask", "prob_diff", "modified_tokens", "modified_probs"):
+            self.columns[name] = self.columns[name][:iterations]
+        self.columns["logit_scores"] = historical_token_scores_logit[:iterations + 1].copy()
+        self.columns["normalized_scores"] = historical_token_scores_normalized[:iterations + 1].copy()
+        stopping_checks = [(iteration, met) for iteration, met in self.stopping_checks if iteration < iterations]
+        self.columns["stopping_iteration"] = np.array([iteration for iteration, _ in stopping_checks], dtype=np.int32)
+        self.columns["stopping_met"] = np.array([met for _, met in stopping_checks], dtype=bool)
+        self.metadata.update(metadata)
+
+    # Number of iterations stored in the trace
+    @property
+    def iterations(self):
+        return len(self.columns["prob_diff"])
+
+    # This method returns the normalized token scores at the end of the run
+    def final_scores(self):
+        return self.columns["normalized_scores"][-1]
+
+    # This method returns a table with one row per iteration to analyze the run
+    def to_frame(self):
+        stopping = dict(zip(self.columns["stopping_iteration"].tolist(), self.columns["stopping_met"].tolist()))
+        rows = []
+        for i in range(self.iterations):
+            alternatives = self.columns["modified_tokens"][i] >= 0
+            rows.append({
+                "iteration": i,
+                "modified_input": self.strings[self.columns["modified_input"][i]],
+                "replaced_indices": np.flatnonzero(self.columns["replaced_mask"][i]).tolist(),
+                "prob_diff": float(self.columns["prob_diff"][i]),
+                "scaled_delta_p": float(self.columns["prob_diff"][i]) / self.metadata["original_token_count"],
+                "modified_tokens": [self.strings[idx] for idx in self.columns["modified_tokens"][i][alternatives]],
+                "modified_probs": self.columns["modified_probs"][i][alternatives].tolist(),
+                "logit_scores": self.columns["logit_scores"][i + 1].tolist(),
+                "normalized_scores": self.columns["normalized_scores"][i + 1].tolist(),
+                "stopping_condition_met": stopping.get(i),
+            })
+        return pd.DataFrame(rows, columns=self.frame_columns)  # The columns are kept even if the run has no iterations
+
+    # This method rebuilds a trace from the table returned by to_frame and the metadata saved with it
+    @classmethod
+    def from_frame(cls, frame, metadata):
+        metadata = dict(metadata)
+        initial_scores = (metadata.pop("initial_logit_scores"), metadata.pop("initial_normalized_scores"))
+        frame = frame.reindex(columns=cls.frame_columns)  # The tables of runs with no iterations may have been saved without columns
+        num_alternatives = max([len(tokens) for tokens in frame["modified_tokens"]], default=0)
+        trace = cls.allocate(len(frame), len(initial_scores[0]), num_alternatives)
+        for i, row in enumerate(frame.itertuples(index=False)):
+            replaced_mask = np.zeros(len(initial_scores[0]), dtype=bool)
+            replaced_mask[list(row.replaced_indices)] = True
+            modified_probs = [[{"token": token, "prob": prob} for token, prob in zip(row.modified_tokens, row.modified_probs)]]
+            trace.record_iteration(i, row.modified_input, replaced_mask, row.prob_diff, modified_probs)
+            if row.stopping_condition_met is not None and not pd.isna(row.stopping_condition_met):
+                trace.record_stopping_check(i, bool(row.stopping_condition_met))
+        logit_scores = np.vstack([initial_scores[0]] + [np.asarray(scores) for scores in frame["logit_scores"]])
+        normalized_scores = np.vstack([initial_scores[1]] + [np.asarray(scores) for scores in frame["normalized_scores"]])
+        trace.finish(len(frame), logit_scores, normalized_scores, metadata)
+        return trace
+
+    # This method saves the trace to a compressed .npz file (the columns as they are) or to a Parquet file (the per-iteration table, it requires pyarrow)
+    def save(self, target, format=None):
+        format = format or trace_file_format(target)
+        if format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(self.to_frame(), preserve_index=False)
+            metadata = dict(self.metadata, initial_logit_scores=self.columns["logit_scores"][0].tolist(), initial_normalized_scores=self.columns["normalized_scores"][0].tolist())
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"reagent_trace": json.dumps(metadata).encode("utf-8")})
+            pq.write_table(table, target)
+        else:
+            np.savez_compressed(target, metadata=np.array(json.dumps(self.metadata)), strings=np.array(self.strings, dtype=str), **self.columns)
+
+    # This method loads a trace saved with save, from a path or a file object
+    @classmethod
+    def load(cls, source, format=None):
+        format = format or trace_file_format(source)
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            table = pq.read_table(source)
+            metadata = json.loads(table.schema.metadata[b"reagent_trace"].decode("utf-8"))
+            return cls.from_frame(table.to_pandas(), metadata)
+        with np.load(source, allow_pickle=False) as data:
+            columns = {name: data[name] for name in data.files if name not in ("metadata", "strings")}
+            return cls(json.loads(str(data["metadata"])), columns, data["strings"].tolist())
+
+# This function guesses the format of a trace file from its name (.parquet or .npz)
+def trace_file_format(file):
+    name = str(getattr(file, "name", file))
+    return "parquet" if name.endswith(".parquet") else "npz"
+
 # This is the main function
-def calculate_feature_importance(original_input, role_description, tokenizer, model):
+# It returns the rating, the cleaned tokens, their normalized scores, a report with the iterations and API calls used by the run and the trace of the run
+# The OpenAI client, the callbacks, the random generator of the perturbations and a progress_callback(iteration, max_iterations) can be given to run it outside of the Streamlit script (see FeatureImportanceJob and XAI_APP_pipeline.py)
+def calculate_feature_importance(original_input, role_description, tokenizer, model, window=REAGENT_WINDOW, convergence_policy=None, client=None, rng=None, progress_callback=None, callbacks=None):
+    from scipy.special import softmax
+    convergence_policy = convergence_policy or get_convergence_policy()
+    window = max(1, window)
+    client = get_client(client)
+    callbacks = get_callbacks(callbacks)
+
+    # Keep track of the work done by this run
+    run_report = {"convergence_policy": convergence_policy.name, "iterations": 0, "stopping_checks": 0, "api_calls": 0, "cache_hits": 0}
+
+    # This function generates the Chat GPT4 answers of several inputs (concurrently if the window allows it), identical prompts are answered from the run cache
+    response_cache = ResponseCache(get_response_disk_cache(callbacks))
+    def generate_probs(inputs):
+        return generate_probs_concurrently(inputs, role_description, window, response_cache, client, callbacks)
+
     # Define the main parameters
     replace_ratio = 0.3 # Percentage of tokens that will be replaced in each iteration for the token importance calculation
     replace_ratio_stopping_condition = 0.7 # Percentage of non important tokens replaced while checking the stopping condition
 
     # Calculate the most probable answers for the given input with Chat GPT4, this will allow us to compare how much each of the input tokens affects the generated answer. Additionally we assure that the given answer by Chat GPT4 is one of the Likert-type scale ones
-    original_probs = extract_probs_information(answer_generation(original_input, role_description))
+    original_probs = generate_probs([original_input])[0]
     original_first_token = original_probs[0][0]['token'].lower() # Extract the value of the first output token to see if it belong to the Likert-typer scale categories and convert it to minus to compare
     #st.write("Original solution: ", original_first_token)
     
@@ -458,7 +1912,7 @@ def calculate_feature_importance(original_input, role_description, tokenizer, mo
         if original_first_token not in ("excellent", "good", "regular", "poor", "bad"): # If the most probable output token is not one of the ones defined for the Likert-type scale we indicate ChatGPT4 to do so. This words have been checked to be single tokens for GPT4 and GPT4-mini tokenizer
             if l == 0: # In the first iteration we indicate Chat GPT4 that the classification was not done correctly, this will be added to the input for future iterations
                 input = (original_input + "\n\nIMPORTANT: Your previous response did not provide a classification based on the following categories: excellent, good, regular, bad, awful. This time, ensure it aligns with the specified criteria.")
-            original_probs = extract_probs_information(answer_generation(input, role_description))
+            original_probs = generate_probs([input])[0]
             original_first_token = original_probs[0][0]['token'].lower()
         else: # Finish the loop if the answer is generated accorfing to the given criteria
             break
@@ -468,9 +1922,10 @@ def calculate_feature_importance(original_input, role_description, tokenizer, mo
     original_token_ids = original_tokens['input_ids'][0] # Token ids
     original_token_count = len(original_token_ids) - 2 # How many tokens we have and exclude <s> and </s>
 
-    # Handle possible errors due to long inputs
-    if original_token_count > 512:
-        raise ValueError("Input exceeds the maximum token limit of 512. Please shorten the input text.")
+    # Handle possible errors due to long inputs (the limit of the masked LM includes the special tokens)
+    max_length = masked_lm_max_length(tokenizer, model)
+    if len(original_token_ids) > max_length:
+        raise ValueError(f"Input exceeds the maximum token limit of {max_length}. Please shorten the input text.")
     
     # Define the common tokens in the input structure to give them a higher score and speed up the convergence process. Since our goal is to gain a better UX and we know the structure of the inputs we have, this approach can get us closer to that point.
     common_parts = [
@@ -479,128 +1934,116 @@ def calculate_feature_importance(original_input, role_description, tokenizer, mo
     ]
     common_token_ids = tokenizer(" ".join(common_parts), return_tensors='pt')['input_ids'][0]
 
-    # Initialize scores with a bias for common tokens
-    token_scores_logit = []
-    scaled_probs_diff_vect = []
-    for idx, token_id in enumerate(original_token_ids):
-        if token_id in common_token_ids:  # Check if token is part of the common structure
-            token_scores_logit.append(0.1)  # Assign a higher initial value (0.1)
-        else:
-            token_scores_logit.append(0)  # Assign the default value (0)
-        scaled_probs_diff_vect.append(0)
+    # Define the calculation loop conditions
+    stop = False
+    max_iterations = 30 # Maximum number of loop iterations
 
-    # Normalize token_scores into another list for the calculations
+    # Initialize scores with a bias for common tokens, the ones that are part of the common structure get a higher initial value (0.1) and the rest the default value (0)
+    token_scores_logit = np.where(np.isin(original_token_ids.numpy(), common_token_ids.numpy()), 0.1, 0.0)
+
+    # Normalize token_scores into another array for the calculations
     token_scores_normalized = softmax(token_scores_logit)
         
-    # Initialize a dictionary to store historical values
-    historical_token_scores_logit = {}
-    historical_token_scores_normalized = {}
-    historical_token_scores_logit[0] = token_scores_logit.copy()  # Store the initial list of logit values
-    historical_token_scores_normalized[0] = token_scores_normalized.copy()  # Store the initial list of normalized values
+    # Preallocate the arrays storing the scores after each iteration (row 0 keeps the initial values)
+    historical_token_scores_logit = np.zeros((max_iterations + 1, len(token_scores_logit)))
+    historical_token_scores_normalized = np.zeros((max_iterations + 1, len(token_scores_logit)))
+    historical_token_scores_logit[0] = token_scores_logit  # Store the initial logit values
+    historical_token_scores_normalized[0] = token_scores_normalized  # Store the initial normalized values
 
-    # Create a list to store each iteration data and check it once the process is finished
-    all_iterations_data = []  # List to store iteration data
+    # Only the first original_token_count positions are updated by the ReAgent method
+    updated_mask = np.arange(len(token_scores_logit)) < original_token_count
 
-    # Define the calculation loop conditions
-    stop = False
-    max_iterations = 30 # Maximum number of loop iterations
-    min_iterations = 10 # Minimum number of loop iterations
+    # Create a trace to store each iteration data and check it once the process is finished
+    trace = ReAgentTrace.allocate(max_iterations, len(token_scores_logit))
+    completed_iterations = 0
+
+    # Draw the masks of all the iterations up front and fill them with RoBERTa in batched forward passes, the random masks do not depend on the LLM responses
+    perturbation_masks = draw_perturbation_masks(original_token_count, replace_ratio, max_iterations, rng or random)
+    perturbed_inputs = substitute_tokens_batch(original_token_ids, perturbation_masks, tokenizer, model)
+
+    # The Chat GPT4 answers are generated concurrently for windows of iterations: the answers of the modified inputs at the start of each window and the stopping condition answers at its end
+    # The score updates and stopping checks are still applied in iteration order, so the results are the same as with the sequential loop (window=1)
+    stopping_inputs = []  # (iteration, input) pairs of the stopping conditions to check at the end of the window
 
     # Iterative importance evaluation until the stopping condition is met
     for i in range(max_iterations):
-        iteration_data = {}  # Initialize a dictionary for the current iteration
-        iteration_data["iteration"] = i
+        if i % window == 0:
+            window_modified_probs = generate_probs(perturbed_inputs[i:i + window])
         #st.write(i)
 
         # 1. MODIFY THE ORIGINAL INPUT CHANGING "replace_ratio" % OF THE TOKENS
         
-        # Modify the original input according to the replace ratio and obtain which tokens have been modified
-        modified_input, replaced_indices = substitute_tokens(original_token_ids, original_token_count, replace_ratio, tokenizer, model)
-        
-        # Save replaced indices
-        iteration_data["original_input"] = original_input
-        iteration_data["modified_input"] = modified_input
-        iteration_data["replaced_indices"] = replaced_indices
+        # Take the input modified according to the replace ratio and which tokens have been modified
+        modified_input = perturbed_inputs[i]
+        replaced_indices = perturbation_masks[i]
 
         # 2. CALCULATE THE OUTPUT PROBS FOR THE NEW MODIFIED INPUT
         
-        # Calculate probs for the modified input
-        modified_probs = extract_probs_information(answer_generation(modified_input, role_description))
-
-        #Save the probs information
-        iteration_data["original_probs"] = original_probs
-        iteration_data["modified_probs"] = modified_probs
+        # Take the probs of the modified input from the current window
+        modified_probs = window_modified_probs[i % window]
 
         # 3. COMPARE THE NEW PROBS WITH THE OLD PROBS AND ASIGN A SCORE TO EACH OF THE TOKENS ACCORDING TO THAT
 
         # Step 3.1: Calculate the difference in the first output token probability
         prob_diff = calculate_prob_difference(original_probs, modified_probs)
-        iteration_data["prob_diff"] = prob_diff
 
         # Step 3.2: Update importance scores for replaced tokens according to the formulas described in the ReAgent paper
         # Step 3.2.1 Scale the prob difference
         scaled_diff = prob_diff / original_token_count
-        iteration_data["scaled_delta_p"] = scaled_diff
-        # Step 3.2.2 Create the Scaled prob differences vector according to the ReAgent method  
-        for idx in range(original_token_count): # Add scaled negative update for the non-replaced tokens
-            if idx in replaced_indices:
-                scaled_probs_diff_vect[idx] = scaled_diff # Add scaled positive value for the replaced tokens
-            elif idx not in replaced_indices:
-                scaled_probs_diff_vect[idx] = -scaled_diff # Add scaled negative value for the non-replaced tokens
-
-        # Save scaled_probs_diff_vect and pre-softmax token scores
-        iteration_data["scaled_probs_diff_vect"] = scaled_probs_diff_vect.copy()
-        iteration_data["logit_scores_before_logit_update"] = token_scores_logit.copy()
+        # Step 3.2.2 Create the Scaled prob differences vector according to the ReAgent method (positive for the replaced tokens and negative for the rest) and calculate the logit update
+        replaced_mask = np.zeros(len(token_scores_logit), dtype=bool)
+        replaced_mask[replaced_indices] = True
+        scaled_probs_diff_vect, logit_update = calculate_logit_update(scaled_diff, replaced_mask, updated_mask, replace_ratio)
                 
-        # Step 3.3: Calculate logit update
-        for p in range(original_token_count):
-            logit_term = (scaled_probs_diff_vect[p] + 1) / 2
-            if (1 - logit_term) == 0: # Handle ZeroDivision Errors
-                epsilon = 1e-10
-                logit_value = math.log((logit_term+epsilon)/(1-logit_term+epsilon))
-                if p in replaced_indices: # Ensure that token importance updates maintain the total values with no variation
-                    logit_value = (1 - replace_ratio) * logit_value
-                elif p not in replaced_indices:
-                    logit_value = replace_ratio * logit_value 
-            else:
-                logit_value = math.log(logit_term/(1-logit_term))
-                if p in replaced_indices:
-                    logit_value = (1 - replace_ratio) * logit_value
-                elif p not in replaced_indices:
-                    logit_value = replace_ratio * logit_value 
-            token_scores_logit[p] = historical_token_scores_logit[i][p] + logit_value # The updated token score is the token score from the last iteration plus the logit
-
-        iteration_data["logit_scores_before_softmax"] = token_scores_logit.copy()
+        # Step 3.3: The updated token score is the token score from the last iteration plus the logit (the scores of every iteration are kept in the historical arrays)
+        historical_token_scores_logit[i+1] = historical_token_scores_logit[i] + logit_update
+        token_scores_logit = historical_token_scores_logit[i+1]
             
         # Step 3.5: Normalize scores using softmax
         token_scores_normalized = softmax(token_scores_logit)
-        iteration_data["normalized_scores_after_softmax"] = token_scores_normalized.copy()
-    
-        # Update historical scores with this iteration values
-        historical_token_scores_logit[i+1] = token_scores_logit.copy()
-        historical_token_scores_normalized[i+1] = token_scores_normalized.copy()
+        historical_token_scores_normalized[i+1] = token_scores_normalized
 
         # 4. FINISH CALCULATING TOKEN SCORES AND CHECK IF THE STOPPING CONDITION IS MET
 
-        all_iterations_data.append(iteration_data)  # Add the current iteration data to the list
+        trace.record_iteration(i, modified_input, replaced_mask, prob_diff, modified_probs)  # Add the current iteration data to the trace
+        completed_iterations = i + 1
+        if progress_callback is not None:
+            progress_callback(completed_iterations, max_iterations)
 
-        # Calculate convergence to check if the score calculation loop is ready or if the iteration should continue according to the defined stopping condition (ReAgent one or average tokens scores are below a certain threshold in the last defined minimum number of iterations)
-        stop = calculate_stopping_condition(original_token_ids, original_token_count, replace_ratio_stopping_condition, token_scores_normalized, original_probs, role_description, tokenizer, model)
-        if (i >  min_iterations) and (stop == True):
+        # Calculate convergence to check if the score calculation loop is ready or if the iteration should continue according to the convergence policy (the ReAgent stopping condition in the iterations it chooses, or a local criterion)
+        if convergence_policy.should_check(i):
+            stopping_inputs.append((i, build_stopping_input(original_token_ids, original_token_count, replace_ratio_stopping_condition, token_scores_normalized, tokenizer, model)))
+        if convergence_policy.has_converged(historical_token_scores_normalized, i):
             #st.write("Convergence reached.")
             break
+        if (i + 1) % window != 0 and i != max_iterations - 1:
+            continue # Keep computing the window before checking its stopping conditions
+
+        # Check the stopping conditions of the window in iteration order and roll back the iterations computed after the first one that converged
+        stop = False
+        if stopping_inputs:
+            stopping_probs = generate_probs([stopping_input for _, stopping_input in stopping_inputs])
+            for (j, _), modified_probs in zip(stopping_inputs, stopping_probs):
+                run_report["stopping_checks"] += 1
+                stop = is_stopping_condition_met(original_probs, modified_probs)
+                trace.record_stopping_check(j, stop)
+                if stop == True:
+                    break
+            stopping_inputs = []
+        if stop == True:
+            #st.write("Convergence reached.")
+            completed_iterations = j + 1
+            token_scores_normalized = historical_token_scores_normalized[j + 1].copy()
+            break
     
-    # Handle unsupported types (Numpy Arrays)
-    for entry in all_iterations_data: 
-        for key, value in entry.items():
-            if isinstance(value, np.ndarray):
-                entry[key] = value.tolist()  # Convert NumPy array to list
+    run_report["iterations"] = completed_iterations
+
     # Convert token IDs to human-readable tokens
     raw_tokens = tokenizer.convert_ids_to_tokens(original_token_ids.tolist())
     
     # Clean the tokens for visualization purposes
-    cleaned_tokens = clean_tokens(raw_tokens)
-    cleaned_tokens = [token for token in cleaned_tokens if token not in ["<s>", "</s>"]] # Remove first and last token to avoid visualization errors
+    cleaned_tokens = clean_tokens(raw_tokens, tokenizer)
+    cleaned_tokens = [token for token in cleaned_tokens if token not in (tokenizer.cls_token, tokenizer.sep_token)] # Remove first and last token (<s> and </s> for RoBERTa) to avoid visualization errors
     #st.write("Cleaned Tokens:", cleaned_tokens)
 
     extra_input = (f"You are a design expert skilled in critically evaluating design proposals. Your task is to classify each proposal as Bad, Poor, Regular, Good, or Excellent, based on its structural feasibility, functionality, innovation, efficiency, and relevance to the design goal.\n"
@@ -614,14 +2057,14 @@ def calculate_feature_importance(original_input, role_description, tokenizer, mo
                     )
 
     strict_input = original_input + extra_input
-    strict_probs = extract_probs_information(answer_generation(strict_input, role_description))
+    strict_probs = generate_probs([strict_input])[0]
     strict_first_token = strict_probs[0][0]['token'].lower()
     # Asure that the first output token from the strict input follows the descrived rating criteria in the role description
     for o in range(10):
         if strict_first_token not in ("excellent", "good", "regular", "poor", "bad"):
             if o == 0:
                 strict_input = (strict_input + "\n\nIMPORTANT: Your previous response did not provide a classification based on the following categories: bad, poor, regular, good, excellent. This time, ensure it aligns with the specified criteria.")
-            strict_probs = extract_probs_information(answer_generation(strict_input, role_description))
+            strict_probs = generate_probs([strict_input])[0]
             strict_first_token = strict_probs[0][0]['token'].lower()
         else:
             break
@@ -629,4 +2072,365 @@ def calculate_feature_importance(original_input, role_description, tokenizer, mo
     if strict_first_token not in ("excellent", "good", "regular", "poor", "bad"):
         strict_first_token = original_first_token
 
-    return strict_first_token, cleaned_tokens, token_scores_normalized
\ No newline at end of file
+    # Count the API calls made and the ones saved by the cache
+    run_report["api_calls"] = response_cache.misses
+    run_report["cache_hits"] = response_cache.hits
+
+    # Keep the scores history and the run-level values in the trace
+    trace.finish(completed_iterations, historical_token_scores_logit, historical_token_scores_normalized, {
+        "original_input": original_input,
+        "role_description": role_description,
+        "rating": strict_first_token,
+        "original_probs": original_probs,
+        "strict_probs": strict_probs,
+        "token_ids": original_token_ids.tolist(),
+        "cleaned_tokens": cleaned_tokens,
+        "original_token_count": original_token_count,
+        "replace_ratio": replace_ratio,
+        "report": run_report,
+    })
+
+    return strict_first_token, cleaned_tokens, token_scores_normalized, run_report, trace
+
+# FEATURE IMPORTANCE BACKGROUND JOBS
+
+# Number of feature importance calculations run at the same time in the background (each of them also generates its answers concurrently) and seed of their random generators
+REAGENT_JOB_WORKERS = int(os.environ.get("XAI_APP_REAGENT_JOB_WORKERS", 2))
+REAGENT_JOB_SEED = 42
+
+# The job workers are started once per server process and shared by all the sessions, so the number of calculations running at the same time is bounded
+reagent_job_pool = None
+reagent_job_pool_lock = threading.Lock()
+
+# This function returns the shared feature importance job pool, creating it the first time it is needed
+def get_reagent_job_pool():
+    global reagent_job_pool
+    with reagent_job_pool_lock:
+        if reagent_job_pool is None:
+            reagent_job_pool = ThreadPoolExecutor(max_workers=REAGENT_JOB_WORKERS, thread_name_prefix="reagent-job")
+        return reagent_job_pool
+
+# This class is a feature importance calculation running in the shared job pool, it keeps its progress so the pages can poll it while the users keep working
+# Each job draws its perturbations from its own random generator seeded with the input, so parallel jobs do not share the global random state and an option always gets the same perturbations
+class FeatureImportanceJob:
+    def __init__(self, original_input, role_description, client, convergence_policy_name=None, seed=None):
+        self.original_input = original_input
+        self.seed = seed if seed is not None else f"{REAGENT_JOB_SEED}:{original_input}"
+        self.started = False
+        self.progress = 0.0
+        self.future = get_reagent_job_pool().submit(self.run, role_description, client, convergence_policy_name)
+
+    # This method runs the calculation in a worker thread
+    def run(self, role_description, client, convergence_policy_name):
+        self.started = True
+        tokenizer, model = get_masked_lm()
+        return calculate_feature_importance(
+            self.original_input, role_description, tokenizer, model,
+            convergence_policy=get_convergence_policy(convergence_policy_name),
+            client=client,
+            rng=random.Random(self.seed),
+            progress_callback=self.update_progress,
+        )
+
+    # This method records the iterations done so far
+    def update_progress(self, iteration, max_iterations):
+        self.progress = iteration / max_iterations
+
+    # Job status: queued, running, done or failed
+    @property
+    def status(self):
+        if not self.future.done():
+            return "running" if self.started else "queued"
+        return "failed" if self.future.exception() is not None else "done"
+
+    # This method returns the results of calculate_feature_importance once the job is done (it raises the error if the job failed)
+    def result(self):
+        return self.future.result()
+
+
+# 5. BACKGROUND WARM-UP FUNCTIONS
+
+# The slow first time steps of the app (loading RoBERTa, compiling the UMAP/HDBSCAN numba code and loading WordNet) are run in a background thread when the server starts, so the first users do not wait for them
+WARM_UP_STEPS = ["UMAP/HDBSCAN", "RoBERTa", "WordNet"]
+warm_up_status = {}
+warm_up_thread = None
+warm_up_lock = threading.Lock()
+
+# This function starts the background warm-up, it can be called from every page since it only runs once per server process
+def start_warm_up():
+    global warm_up_thread
+    with warm_up_lock:
+        if warm_up_thread is None:
+            for step in WARM_UP_STEPS:
+                warm_up_status[step] = "pending"
+            warm_up_thread = threading.Thread(target=run_warm_up, name="xai-app-warm-up", daemon=True)
+            warm_up_thread.start()
+
+# This function runs the warm-up steps and records their status
+def run_warm_up():
+    # The clustering workers run in their own processes, so they are started and compiled in parallel with the rest of the steps
+    try:
+        pool = get_clustering_pool()
+        worker_futures = [pool.submit(warm_up_clustering) for _ in range(CLUSTERING_WORKERS)]
+    except Exception:
+        worker_futures = []
+
+    for step, warm_up_function in [("UMAP/HDBSCAN", warm_up_clustering), ("RoBERTa", warm_up_masked_lm), ("WordNet", warm_up_wordnet)]:
+        warm_up_status[step] = "running"
+        try:
+            warm_up_function()
+            if step == "UMAP/HDBSCAN":
+                for future in worker_futures:
+                    future.result()
+            warm_up_status[step] = "done"
+        except Exception as e:
+            warm_up_status[step] = f"failed ({e})"
+
+# This function triggers the UMAP and HDBSCAN numba compilation (fit, transform and approximate prediction) with a tiny random matrix
+def warm_up_clustering():
+    embeddings = np.random.default_rng(0).normal(size=(20, 8)).astype(np.float32)
+    _, _, _, _, model = reduce_and_cluster(embeddings, return_model=True)
+    model.predict(embeddings[:2])
+
+# This function loads the shared RoBERTa model and runs a dummy masked forward pass
+def warm_up_masked_lm():
+    import torch
+    tokenizer, model = get_masked_lm()
+    inputs = tokenizer(f"In one word how good is {tokenizer.mask_token} as a solution?", return_tensors="pt")
+    with masked_lm_inference_lock, torch.no_grad():
+        masked_lm_logits(model, inputs["input_ids"])
+
+# This function loads the WordNet corpus
+def warm_up_wordnet():
+    from nltk.corpus import wordnet as wn
+    wn.ensure_loaded()
+
+# This function returns True once the given warm-up step has finished (successfully or not)
+def warm_up_finished(step):
+    return warm_up_status.get(step, "done") not in ("pending", "running")
+
+# This function displays the warm-up progress in the sidebar while it is running
+def show_warm_up_status():
+    if not warm_up_status:
+        return
+    finished = [step for step in WARM_UP_STEPS if warm_up_finished(step)]
+    failed = [step for step in WARM_UP_STEPS if warm_up_status[step].startswith("failed")]
+    if len(finished) < len(WARM_UP_STEPS):
+        running = ", ".join(f"{step}: {warm_up_status[step]}" for step in WARM_UP_STEPS)
+        st.sidebar.progress(len(finished) / len(WARM_UP_STEPS), text=f"Preparing models in the background ({running})")
+    for step in failed:
+        st.sidebar.warning(f"{step} could not be prepared in advance, it will be loaded when needed: {warm_up_status[step]}")
+
+
+# 6. DIAGNOSTICS FUNCTIONS
+
+# This function returns the memory used by the server process and by the resources shared between the sessions
+def memory_usage_report():
+    report = {}
+
+    # Current and peak resident memory of the process (Linux reports them in /proc and in kB)
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    report["Process resident memory (MB)"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    report["Process peak resident memory (MB)"] = int(line.split()[1]) / 1024
+    except OSError:
+        try:
+            import resource
+            report["Process peak resident memory (MB)"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        except ImportError:
+            pass
+
+    # Shared models and caches
+    if masked_lms:
+        report["Shared masked LM parameters (MB)"] = sum(model.memory_bytes() for _, model in masked_lms.values()) / 1024 ** 2
+    report["Shared masked LM instances"] = len(masked_lms)
+    report["Local embedding models loaded"] = sum(isinstance(backend, LocalEmbeddingBackend) and not backend.shares_masked_lm for backend in embedding_backends.values())
+    report["Clustering results in memory"] = len(clustering_cache.entries)
+    report["Masked LM predictions in memory"] = len(masked_lm_cache.entries)
+    report["Masked LM cache hits"] = masked_lm_cache.hits
+    report["Masked LM cache misses"] = masked_lm_cache.misses
+    report["OpenAI requests"] = sum(client.requests for client in openai_clients.values())
+    report["OpenAI retries"] = sum(client.retries for client in openai_clients.values())
+
+    # Number of browser sessions connected to the server (Streamlit internal API, it may not be available)
+    try:
+        from streamlit.runtime import Runtime
+        report["Active sessions"] = len(Runtime.instance()._session_mgr.list_active_sessions())
+    except Exception:
+        pass
+
+    return report
+
+
+# 7. OPENAI CLIENT FUNCTIONS
+
+# Define the request rate allowed by the OpenAI quota (shared by all the sessions that use the same API key), the maximum number of concurrent requests of each model and the retries of the temporary errors
+OPENAI_REQUESTS_PER_MINUTE = float(os.environ.get("XAI_APP_OPENAI_REQUESTS_PER_MINUTE", 500))
+OPENAI_BURST = int(os.environ.get("XAI_APP_OPENAI_BURST", 20))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("XAI_APP_OPENAI_MAX_CONCURRENCY", 16)) # For the models not listed below
+OPENAI_MODEL_CONCURRENCY = {
+    "o1-mini": 8, # Slow reasoning requests, they would hold most of the connections
+    "gpt-4o-mini": 32, # The ReAgent scoring sends many one-token requests
+    "text-embedding-3-small": 8,
+}
+OPENAI_MAX_RETRIES = int(os.environ.get("XAI_APP_OPENAI_MAX_RETRIES", 5))
+OPENAI_BACKOFF_BASE = 0.5 # Seconds, doubled after each failed attempt
+OPENAI_BACKOFF_MAX = 30.0
+OPENAI_TIMEOUT = 120.0
+
+# List prices of the models in USD per million (input, output) tokens, used to estimate the cost of the batch runs (check the current OpenAI prices before relying on them)
+OPENAI_PRICES = {
+    "o1-mini": (1.10, 4.40),
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+# This class implements a token bucket limiter, the tokens are refilled at a constant rate up to the burst capacity and every request takes one of them (waiting for it if there are none left)
+# A rate limit answer pauses the bucket so all the sessions wait for the quota to recover instead of sending more requests
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    # This function waits until a token is available and takes it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    # This function stops handing out tokens for the given number of seconds and empties the bucket
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+# This function returns whether an OpenAI error is temporary (connection problems, timeouts, rate limits and server errors) and the request can be retried
+def is_retryable_openai_error(error):
+    import openai
+    if isinstance(error, openai.APIConnectionError): # Includes the timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+# This function returns the seconds that the server asked to wait before retrying in the Retry-After headers of an error, or None if it did not ask for any
+def openai_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass # Retry-After can also be an HTTP date, the exponential backoff is used instead
+    return None
+
+# This class wraps the OpenAI client of one API key, it is shared by all the sessions that use the key so their HTTP connections are kept alive and reused
+# Every request waits for the token bucket and for a free slot of its model, and the temporary errors are retried with jittered exponential backoff (or after the time the server asks for)
+class RateLimitedOpenAIClient:
+    def __init__(self, api_key, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, burst=OPENAI_BURST, max_retries=OPENAI_MAX_RETRIES):
+        from openai import OpenAI, DefaultHttpxClient
+        import httpx
+        max_connections = max([OPENAI_MAX_CONCURRENCY] + list(OPENAI_MODEL_CONCURRENCY.values()))
+        # The retries of the library are disabled since they would not wait for the shared limiter
+        self.client = OpenAI(
+            api_key=api_key,
+            max_retries=0,
+            timeout=OPENAI_TIMEOUT,
+            http_client=DefaultHttpxClient(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)),
+        )
+        self.limiter = TokenBucket(requests_per_minute / 60, burst)
+        self.max_retries = max_retries
+        self.model_slots = {}
+        self.model_slots_lock = threading.Lock()
+        self.jitter = random.Random() # Own generator so the backoff does not change the seeded perturbations
+        self.requests = 0
+        self.retries = 0
+        self.usage = {}
+        self.usage_lock = threading.Lock()  # The requests, retries and usage counters are updated by the threads of every session
+
+    # This function returns the semaphore that limits the concurrent requests of a model
+    def model_slot(self, model):
+        with self.model_slots_lock:
+            if model not in self.model_slots:
+                self.model_slots[model] = threading.BoundedSemaphore(OPENAI_MODEL_CONCURRENCY.get(model, OPENAI_MAX_CONCURRENCY))
+            return self.model_slots[model]
+
+    # This function sends a request, retrying the temporary errors until max_retries is reached (then the last error is raised)
+    def request(self, create, **kwargs):
+        with self.model_slot(kwargs["model"]):
+            for attempt in range(self.max_retries + 1):
+                self.limiter.acquire()
+                try:
+                    with self.usage_lock:
+                        self.requests += 1
+                    response = create(**kwargs)
+                    self.record_usage(kwargs["model"], response)
+                    return response
+                except Exception as e:
+                    if attempt == self.max_retries or not is_retryable_openai_error(e):
+                        raise
+                    with self.usage_lock:
+                        self.retries += 1
+                    delay = openai_retry_after(e)
+                    if delay is None:
+                        delay = self.jitter.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt)) # Full jitter, so the sessions that failed together do not retry together
+                    if getattr(e, "status_code", None) == 429:
+                        self.limiter.pause(delay)
+                    time.sleep(delay)
+
+    # This function adds a successful request and its tokens to the usage of its model
+    def record_usage(self, model, response):
+        usage = getattr(response, "usage", None)
+        with self.usage_lock:
+            model_usage = self.usage.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0})
+            model_usage["requests"] += 1
+            if usage is not None:
+                model_usage["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                model_usage["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+
+    # This function generates a chat completion, it takes the same arguments as client.chat.completions.create
+    def chat_completion(self, **kwargs):
+        return self.request(self.client.chat.completions.create, **kwargs)
+
+    # This function generates embeddings, it takes the same arguments as client.embeddings.create
+    def create_embeddings(self, **kwargs):
+        return self.request(self.client.embeddings.create, **kwargs)
+
+# The clients are created once per server process and API key (the keys are stored hashed)
+openai_clients = {}
+openai_clients_lock = threading.Lock()
+
+# This function returns the shared rate limited client of an API key, creating it the first time it is needed
+def get_openai_client(api_key):
+    key = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    with openai_clients_lock:
+        if key not in openai_clients:
+            openai_clients[key] = RateLimitedOpenAIClient(api_key)
+        return openai_clients[key]
+
+# This function estimates the cost in USD of the usage of a model (None if its price is unknown)
+def estimate_openai_cost(model, usage):
+    if model not in OPENAI_PRICES:
+        return None
+    input_price, output_price = OPENAI_PRICES[model]
+    return (usage["prompt_tokens"] * input_price + usage["completion_tokens"] * output_price) / 1e6
\ No newline at end of file
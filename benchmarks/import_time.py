@@ -0,0 +1,89 @@
+# IMPORT-TIME BENCHMARK FOR THE STREAMLIT PAGES
+# This script measures the cold start time of each page: the top-level imports of the page are run in a fresh Python process and timed
+# The results can be appended to a JSONL file to track how the cold start of each page evolves over time
+# Usage: python benchmarks/import_time.py [--repeat 5] [--output import_times.jsonl] [--detail]
+
+# IMPORT LIBRARIES
+import argparse
+import ast
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# This function returns the app pages, starting with the main page
+def find_pages():
+    return [os.path.join(REPO_ROOT, "Main_Page.py")] + sorted(glob.glob(os.path.join(REPO_ROOT, "pages", "*.py")))
+
+# This function extracts the top-level import statements of a page, which are the ones run every time the page is opened
+def extract_imports(page_path):
+    with open(page_path, "r", encoding="utf-8") as file:
+        tree = ast.parse(file.read(), filename=page_path)
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return "\n".join(ast.unparse(node) for node in imports)
+
+# This function runs the imports in a fresh Python process and returns their wall-clock time in seconds
+def time_imports(import_code, detail=False):
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"{import_code}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    command = [sys.executable] + (["-X", "importtime"] if detail else []) + ["-c", code]
+    result = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True, env={**os.environ, "PYTHONPATH": REPO_ROOT})
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error")
+    return float(result.stdout.strip().splitlines()[-1]), result.stderr
+
+# This function returns the slowest modules of a "python -X importtime" report
+def slowest_modules(importtime_report, top=10):
+    modules = []
+    for line in importtime_report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+# This function returns the current git commit to know which version of the code was measured
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start import time of each Streamlit page.")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of fresh processes measured per page.")
+    parser.add_argument("--output", help="JSONL file where the results are appended to track them over time.")
+    parser.add_argument("--detail", action="store_true", help="Show the slowest modules imported by each page.")
+    args = parser.parse_args()
+
+    results = []
+    for page_path in find_pages():
+        page_name = os.path.relpath(page_path, REPO_ROOT)
+        import_code = extract_imports(page_path)
+        try:
+            timings = [time_imports(import_code)[0] for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{page_name:<45} failed: {e}")
+            continue
+        results.append({"page": page_name, "min_seconds": min(timings), "median_seconds": statistics.median(timings)})
+        print(f"{page_name:<45} min {min(timings):7.3f}s   median {statistics.median(timings):7.3f}s")
+        if args.detail:
+            _, report = time_imports(import_code, detail=True)
+            for cumulative, module in slowest_modules(report):
+                print(f"    {cumulative / 1e6:7.3f}s  {module}")
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": current_commit(), "python": sys.version.split()[0], "results": results}) + "\n")
+
+if __name__ == "__main__":
+    main()
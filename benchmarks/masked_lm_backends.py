@@ -0,0 +1,149 @@
+# MASKED LM BACKENDS BENCHMARK
+# This script compares the inference backends of the ReAgent masked LM (see MASKED_LM_BACKENDS in XAI_APP_utils.py) on the perturbations generated by the app
+# Each backend is measured in a fresh Python process: preparation time, memory, latency of the batched perturbation predictions and agreement of the predicted tokens with the eager float32 model
+# Usage: python benchmarks/masked_lm_backends.py [--backends eager quantized torchscript onnx] [--threads 4] [--repeat 5] [--output masked_lm_backends.jsonl]
+
+# IMPORT LIBRARIES
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Prompts of different lengths built with the same template as the final results page
+DESIGN_PROBLEM = "a foldable chair for outdoor events that is light, cheap to manufacture and comfortable enough to sit on for several hours"
+PROMPTS = [
+    f"In one word how good is a steel frame as a structural solution for {DESIGN_PROBLEM}?",
+    f"In one word how good is a seat that adapts its shape to the user and distributes the weight evenly across the whole surface as a behavioral solution for {DESIGN_PROBLEM}?",
+    f"In one word how good is {' '.join(['a modular frame of aluminium tubes joined by plastic hinges that lock when the chair is unfolded'] * 6)} as a structural solution for {DESIGN_PROBLEM}?",
+]
+
+# This function returns the resident and peak resident memory of the process in MB (Linux only)
+def process_memory():
+    memory = {}
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return memory
+
+# This function measures one backend in the current process and returns its results (it is run in a fresh process by main)
+def measure_backend(backend_name, model_name, threads, repeat, seed):
+    import gc
+    import random
+    sys.path.insert(0, REPO_ROOT)
+    from transformers import AutoTokenizer, AutoModelForMaskedLM
+    from XAI_APP_utils import MASKED_LM_MODELS, create_masked_lm_backend, set_torch_threads, draw_perturbation_masks, predict_masked_tokens
+
+    set_torch_threads(threads)  # Each backend is measured in its own process, so the PyTorch threads can be set for all of it
+    checkpoint = MASKED_LM_MODELS.get(model_name, model_name)
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+    model = AutoModelForMaskedLM.from_pretrained(checkpoint).eval()
+    memory_before = process_memory()
+
+    # Prepare the backend and release the original model
+    start = time.perf_counter()
+    backend = create_masked_lm_backend(model, backend_name, threads)
+    prepare_seconds = time.perf_counter() - start
+    del model
+    gc.collect()
+
+    # Predict the perturbations of a full ReAgent run (30 iterations replacing 30% of the tokens) for each prompt
+    prompts = []
+    predictions = []
+    rng = random.Random(seed)
+    for prompt in PROMPTS:
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+        masks_list = draw_perturbation_masks(len(input_ids) - 2, 0.3, 30, rng)
+        predict_masked_tokens(input_ids, masks_list, tokenizer, backend)  # Warm-up pass
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            prompt_predictions = predict_masked_tokens(input_ids, masks_list, tokenizer, backend)
+            timings.append(time.perf_counter() - start)
+        prompts.append({"tokens": len(input_ids), "min_seconds": min(timings), "median_seconds": statistics.median(timings)})
+        predictions.append([list(prediction) for prediction in prompt_predictions])
+
+    memory_after = process_memory()
+    return {
+        "backend": backend_name,
+        "prepare_seconds": prepare_seconds,
+        "weights_mb": backend.memory_bytes() / 1024 ** 2,
+        "rss_delta_mb": memory_after.get("rss_mb", 0) - memory_before.get("rss_mb", 0),
+        "peak_rss_mb": memory_after.get("peak_rss_mb"),
+        "prompts": prompts,
+        "predictions": predictions,
+    }
+
+# This function runs measure_backend in a fresh Python process, so the memory of each backend is measured separately
+def run_backend(backend_name, args):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", backend_name, "--model", args.model, "--threads", str(args.threads), "--repeat", str(args.repeat), "--seed", str(args.seed)]
+    result = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+# This function returns the fraction of masked positions where two backends predict the same token
+def prediction_agreement(predictions, reference_predictions):
+    matches = total = 0
+    for prompt_predictions, prompt_reference in zip(predictions, reference_predictions):
+        for prediction, reference in zip(prompt_predictions, prompt_reference):
+            matches += sum(token == reference_token for token, reference_token in zip(prediction, reference))
+            total += len(reference)
+    return matches / total if total else None
+
+# This function returns the current git commit to know which version of the code was measured
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the inference backends of the ReAgent masked LM.")
+    parser.add_argument("--backends", nargs="+", default=["eager", "quantized", "torchscript", "onnx"], help="Backends to measure, the first one is the reference for the agreement (eager is always measured).")
+    parser.add_argument("--model", default="roberta-base", help="Masked LM to load (a name of the MASKED_LM_MODELS registry or a checkpoint).")
+    parser.add_argument("--threads", type=int, default=0, help="Intra-op threads of the backends (0 keeps the library default).")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs per prompt.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random perturbations.")
+    parser.add_argument("--output", help="JSONL file where the results are appended to track them over time.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure_backend(args.worker, args.model, args.threads, args.repeat, args.seed)))
+        return
+
+    backends = ["eager"] + [backend for backend in args.backends if backend != "eager"]
+    results = []
+    reference_predictions = None
+    for backend_name in backends:
+        try:
+            result = run_backend(backend_name, args)
+        except RuntimeError as e:
+            print(f"{backend_name:<12} failed: {e}")
+            continue
+        if backend_name == "eager":
+            reference_predictions = result["predictions"]
+        result["agreement"] = prediction_agreement(result.pop("predictions"), reference_predictions) if reference_predictions else None
+        results.append(result)
+
+        latencies = "   ".join(f"{prompt['tokens']:>3} tokens {prompt['median_seconds'] * 1000:8.1f}ms" for prompt in result["prompts"])
+        agreement = f"{result['agreement']:.3f}" if result["agreement"] is not None else "  n/a"
+        print(f"{backend_name:<12} prepare {result['prepare_seconds']:6.2f}s   weights {result['weights_mb']:7.1f}MB   RSS +{result['rss_delta_mb']:7.1f}MB   agreement {agreement}   {latencies}")
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as file:
+            file.write(json.dumps({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": current_commit(), "python": sys.version.split()[0], "model": args.model, "threads": args.threads, "results": results}) + "\n")
+
+if __name__ == "__main__":
+    main()
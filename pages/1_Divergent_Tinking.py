@@ -4,15 +4,17 @@
 import streamlit as st
 import json
 import pandas as pd
-from XAI_APP_utils import generate_design_output
+from XAI_APP_utils import get_openai_client, StreamlitCallbacks, start_warm_up, show_warm_up_status
+from XAI_APP_pipeline import DesignPipeline, FBS_ELEMENTS, DEFAULT_REQUIREMENTS
 
 st.set_page_config(layout="wide")  # Set wide layout for the entire app
+start_warm_up()  # Prepare the slow models in the background in case the server was started from this page
+show_warm_up_status()
 
 # API Keys Setup
 if st.session_state.openai_key:
     try:
-        from openai import OpenAI
-        st.session_state.client = OpenAI(api_key=st.session_state.openai_key)  # Store client in session_state to be able to access it from other pages
+        st.session_state.client = get_openai_client(st.session_state.openai_key)  # Store the shared client in session_state to be able to access it from other pages
     except Exception as e:
         st.error(f"Failed to initialize API: {e}")
 else:
@@ -59,11 +61,7 @@ if "client" in st.session_state and "design_problem" in st.session_state:
     # Make the user select the requirements of the design problem to be used
 
     # Define available requirements
-    available_requirements = [
-        "Address buyer needs", "Innovation", "Ensure technical feasibility", 
-        "Minimize cost", "Scalability", "Compliance with safety regulations", 
-        "Compliance with energy regulations", "Sustainability", "Time efficiency"
-    ]
+    available_requirements = DEFAULT_REQUIREMENTS
 
     # Normal multiselect widget
     selected_requirements = st.multiselect(
@@ -86,14 +84,18 @@ if "client" in st.session_state and "design_problem" in st.session_state:
     if st.button("Generate New FBS Ontology Data"):
         with st.spinner("Generating FBS ontology data..."):
             try:
-                # Generate FBS elements for the single design problem
+                # Generate FBS elements (defined as (ontology element, definition, example) in FBS_ELEMENTS) for the single design problem, the three categories are requested at the same time
+                pipeline = DesignPipeline(st.session_state.client, callbacks=StreamlitCallbacks())
+                fbs_outputs, fbs_errors = pipeline.generate_solutions(design_problem, role_description, FBS_ELEMENTS)
                 fbs_entry = {
                     "Design Goal": design_problem,
                     "Requirements": selected_requirements,
-                    "Functions_1": generate_design_output(design_problem, "functions", role_description, "Functions define the **purpose** of the design, describing **what it is for**.", "increase engine power output, improve fuel efficiency, reduce emissions..."),
-                    "Behaviors_1": generate_design_output(design_problem, "behaviors", role_description, "Behaviors describe the **attributes** that can be derived from the design object’s structure, describing **what it does**.", "rotates at high speed using exhaust gases, compresses air to increase air mass flow, generates heat due to friction and pressure..."),
-                    "Structures_1": generate_design_output(design_problem, "structures", role_description, "Structures define the **physical components, materials, or topology** that make up the design, describing **what it consists of**. They should be tangible elements, NOT descriptions of behavior.", "compressor, turbine, rotating shaft, steel housing, ball bearings, intercooler pipes..."),
+                    **fbs_outputs,
                 }
+                if fbs_errors:
+                    fbs_entry["Errors"] = fbs_errors
+                    for key, error in fbs_errors.items():
+                        st.warning(f"{key.split('_')[0]} could not be generated: {error}")
                 
                 # Save the entry to a JSON file
                 file_name = "fbs_ontology_data.json"
@@ -2,17 +2,17 @@
 
 # IMPORT LIBRARIES
 import streamlit as st
-from sklearn.metrics.pairwise import cosine_similarity
-import pandas as pd
-from XAI_APP_utils import generate_embeddings, reduce_and_cluster, plot_interactive_clusters, rank_by_similarity, normalize_embeddings, enrich_with_wordnet
+from XAI_APP_utils import get_openai_client, StreamlitCallbacks, plot_interactive_clusters, rank_by_similarity, enrich_with_wordnet, drop_failed_embeddings, get_embedding_backend, SimilarityEngine, get_solution_index, start_warm_up, show_warm_up_status
+from XAI_APP_pipeline import DesignPipeline
 
 st.set_page_config(layout="wide")  # Set wide layout for the entire app
+start_warm_up()  # Prepare the slow models in the background in case the server was started from this page
+show_warm_up_status()
 
 # API Keys Setup
 if st.session_state.openai_key:
     try:
-        from openai import OpenAI
-        st.session_state.client = OpenAI(api_key=st.session_state.openai_key)  # Store client in session_state to be able to access it from other pages
+        st.session_state.client = get_openai_client(st.session_state.openai_key)  # Store the shared client in session_state to be able to access it from other pages
     except Exception as e:
         st.error(f"Failed to initialize API: {e}")
 else:
@@ -44,8 +44,9 @@ st.markdown("""
 """)
 
 # MAIN CODE OF THE FILTERING PART, HERE THE GPT-GENERATED FBS SOLUTIONS ARE VISUALIZED IN A 3D SPACE TO HELP THE DESIGNER UNDERSTAND THEM AND CHOOSE THE BEST ONES ACCORDING TO HIS OWN CRITERIA. HERE DESIGNERS ARE ALSO ALLOWED TO INCLUDE THEIR OWN FBS SOLUTIONS INTO THE DESIGN CYCLE
-# Check if the OpenAI client, the design problem and the GPT-generated FBS solutions exist in session state
-if "client" in st.session_state and "design_problem" in st.session_state and "fbs_table" in st.session_state and "selected_requirements" in st.session_state:
+# Check if the OpenAI client (unless the local embeddings backend is used), the design problem and the GPT-generated FBS solutions exist in session state
+if ("client" in st.session_state or not get_embedding_backend().requires_client) and "design_problem" in st.session_state and "fbs_table" in st.session_state and "selected_requirements" in st.session_state:
+    pipeline = DesignPipeline(st.session_state.get("client"), callbacks=StreamlitCallbacks())
 
     # Retrieve the FBS data from session state and assure there are no empty entries (some could have been created during the data display in the divergent thinking)
     # Check if the lists are already calculated
@@ -90,40 +91,55 @@ if "client" in st.session_state and "design_problem" in st.session_state and "fb
         "behaviors_umap" not in st.session_state or
         "structures_umap" not in st.session_state
     ):        
-        # Generate embeddings
+        # Generate embeddings, dropping the solutions that could not be embedded so the embeddings stay aligned with their labels
         st.write("Preparing functions visualization")
-        functions_embeddings = generate_embeddings(functions_list)
+        functions_embeddings, functions_list = drop_failed_embeddings(pipeline.embed(st.session_state["functions_list"]), st.session_state["functions_list"])
         st.write("Preparing behaviors visualization")
-        behaviors_embeddings = generate_embeddings(behaviors_list)
+        behaviors_embeddings, behaviors_list = drop_failed_embeddings(pipeline.embed(st.session_state["behaviors_list"]), st.session_state["behaviors_list"])
         st.write("Preparing structures visualization")
-        structures_embeddings = generate_embeddings(structures_list)
+        structures_embeddings, structures_list = drop_failed_embeddings(pipeline.embed(st.session_state["structures_list"]), st.session_state["structures_list"])
+        st.session_state["functions_list"] = functions_list
+        st.session_state["behaviors_list"] = behaviors_list
+        st.session_state["structures_list"] = structures_list
 
         # Save embeddings in session state
         st.session_state["functions_embeddings"] = functions_embeddings
         st.session_state["behaviors_embeddings"] = behaviors_embeddings
         st.session_state["structures_embeddings"] = structures_embeddings
-
-        # Dimensionality reduction and clustering
-        functions_umap, functions_clusters, functions_silhouette, functions_ch = reduce_and_cluster(functions_embeddings)
-        st.session_state["functions_umap"] = functions_umap
-        st.session_state["functions_clusters"] = functions_clusters
-        st.session_state["functions_silhouette"] = functions_silhouette
-        st.session_state["functions_ch"] = functions_ch
-
-        behaviors_umap, behaviors_clusters, behaviors_silhouette, behaviors_ch = reduce_and_cluster(behaviors_embeddings)
-        st.session_state["behaviors_umap"] = behaviors_umap
-        st.session_state["behaviors_clusters"] = behaviors_clusters
-        st.session_state["behaviors_silhouette"] = behaviors_silhouette
-        st.session_state["behaviors_ch"] = behaviors_ch
-
-        structures_umap, structures_clusters, structures_silhouette, structures_ch = reduce_and_cluster(structures_embeddings)
-        st.session_state["structures_umap"] = structures_umap
-        st.session_state["structures_clusters"] = structures_clusters
-        st.session_state["structures_silhouette"] = structures_silhouette
-        st.session_state["structures_ch"] = structures_ch
+        for category in ["functions", "behaviors", "structures"]:
+            st.session_state.pop(f"{category}_similarity_engine", None)  # Rebuild the similarity engines from the new embeddings
+
+        # Add the solutions to the history of all the generated solutions so they can be searched in future projects
+        solution_index = get_solution_index()
+        if solution_index is not None:
+            try:
+                solution_index.insert(functions_embeddings, functions_list, "Functions", st.session_state.design_problem)
+                solution_index.insert(behaviors_embeddings, behaviors_list, "Behaviors", st.session_state.design_problem)
+                solution_index.insert(structures_embeddings, structures_list, "Structures", st.session_state.design_problem)
+            except Exception as e:
+                st.warning(f"The solutions could not be added to the solutions history: {e}")
+
+        # Dimensionality reduction and clustering, the three categories are processed in parallel and stored as soon as each one finishes
+        st.write("Clustering the solution spaces")
+        clustering_results = pipeline.cluster({
+            "functions": functions_embeddings,
+            "behaviors": behaviors_embeddings,
+            "structures": structures_embeddings,
+        })
+        for category, (category_umap, category_clusters, category_silhouette, category_ch, category_model) in clustering_results:
+            st.session_state[f"{category}_umap"] = category_umap
+            st.session_state[f"{category}_clusters"] = category_clusters
+            st.session_state[f"{category}_silhouette"] = category_silhouette
+            st.session_state[f"{category}_ch"] = category_ch
+            st.session_state[f"{category}_clustering_model"] = category_model  # Used to place the solutions added in the Convergent Thinking page
     #else:
     #    st.write("Visualization preparation complete")
 
+    # Keep the normalized embeddings matrix of each category in session state to compute all its similarities at once
+    for category in ["functions", "behaviors", "structures"]:
+        if f"{category}_similarity_engine" not in st.session_state:
+            st.session_state[f"{category}_similarity_engine"] = SimilarityEngine(st.session_state[f"{category}_embeddings"], st.session_state[f"{category}_list"])
+
     # Give the user the option to select what kind of output to display to better understand the generated solutions
     # Initialize session state for the selectbox if not already set
     if "selected_option" not in st.session_state:
@@ -132,7 +148,7 @@ if "client" in st.session_state and "design_problem" in st.session_state and "fb
     # Create a selectbox tied to session state using the `key` parameter
     st.selectbox(
         "Choose an option:",
-        ["Display All the Solutions", "Solution Space Visualization", "Order Solutions by Similarity to the Design Problem", "Order Solutions by Similarity to a Given Requirement", "Display Each Solution's Most Similar Requirement"],
+        ["Display All the Solutions", "Solution Space Visualization", "Order Solutions by Similarity to the Design Problem", "Order Solutions by Similarity to a Given Requirement", "Display Each Solution's Most Similar Requirement", "Search Similar Solutions from Past Projects"],
         key="selected_option",  # Automatically syncs with session_state
         help="Select an analysis or visualization option to explore the generated solutions."
     )
@@ -196,15 +212,14 @@ if "client" in st.session_state and "design_problem" in st.session_state and "fb
             """)
 
         # Generate embedding for the design problem
-        design_problem_embedding = generate_embeddings([st.session_state.design_problem])[0]
-        design_problem_embedding = normalize_embeddings([design_problem_embedding])[0]
-
-        fbs_categories = ["Functions", "Behaviors", "Structures"]
-        for category in fbs_categories:
-            st.write(f"#### Ranking {category}:")
-            embeddings = st.session_state[f"{category.lower()}_embeddings"]
-            data_list = st.session_state[f"{category.lower()}_list"]  # Use cleaned list
-            rank_by_similarity(design_problem_embedding, embeddings, data_list)
+        design_problem_embedding = pipeline.embed([st.session_state.design_problem])[0]
+        if design_problem_embedding is None:
+            st.error("The design problem embedding could not be generated, please try again.")
+        else:
+            fbs_categories = ["Functions", "Behaviors", "Structures"]
+            for category in fbs_categories:
+                st.write(f"#### Ranking {category}:")
+                rank_by_similarity(design_problem_embedding, st.session_state[f"{category.lower()}_similarity_engine"])
         
     elif st.session_state.selected_option == "Order Solutions by Similarity to a Given Requirement":
         # Order solutions based on their similarity with a chosen requirement
@@ -225,15 +240,14 @@ if "client" in st.session_state and "design_problem" in st.session_state and "fb
 
         if selected_requirement:
             # Generate embedding for the selected requirement
-            requirement_embedding = generate_embeddings([selected_requirement])[0]
-            requirement_embedding = normalize_embeddings([requirement_embedding])[0]
-
-            fbs_categories = ["Functions", "Behaviors", "Structures"]
-            for category in fbs_categories:
-                st.write(f"#### Ranking {category} for Requirement: {selected_requirement}")
-                embeddings = st.session_state[f"{category.lower()}_embeddings"]
-                data_list = st.session_state[f"{category.lower()}_list"]  # Use cleaned list
-                rank_by_similarity(requirement_embedding, embeddings, data_list)
+            requirement_embedding = pipeline.embed([selected_requirement])[0]
+            if requirement_embedding is None:
+                st.error("The requirement embedding could not be generated, please try again.")
+            else:
+                fbs_categories = ["Functions", "Behaviors", "Structures"]
+                for category in fbs_categories:
+                    st.write(f"#### Ranking {category} for Requirement: {selected_requirement}")
+                    rank_by_similarity(requirement_embedding, st.session_state[f"{category.lower()}_similarity_engine"])
 
     elif st.session_state.selected_option == "Display Each Solution's Most Similar Requirement":
         # Display each solution's most similar requirement
@@ -247,28 +261,47 @@ if "client" in st.session_state and "design_problem" in st.session_state and "fb
             """)
 
         # Generate embeddings for all requirements
-        requirement_embeddings = generate_embeddings(st.session_state.selected_requirements)
-        requirement_embeddings = normalize_embeddings(requirement_embeddings)
+        requirement_embeddings, requirement_labels = drop_failed_embeddings(pipeline.embed(st.session_state.selected_requirements), st.session_state.selected_requirements)
 
         fbs_categories = ["Functions", "Behaviors", "Structures"]
         for category in fbs_categories:
             st.write(f"#### Most Similar Requirements for {category}:")
-            embeddings = st.session_state[f"{category.lower()}_embeddings"]
-            data_list = st.session_state[f"{category.lower()}_list"]  # Use cleaned list
 
-            most_similar_requirements = []
-            for i, solution_embedding in enumerate(embeddings):
-                similarities = cosine_similarity([solution_embedding], requirement_embeddings)[0]
-                most_similar_index = similarities.argmax()
-                most_similar_requirement = st.session_state.selected_requirements[most_similar_index]
-                most_similar_requirements.append((data_list[i], most_similar_requirement, similarities[most_similar_index]))
+            # Match all the solutions of the category with their most similar requirement at once
+            df = st.session_state[f"{category.lower()}_similarity_engine"].most_similar(requirement_embeddings, requirement_labels)
 
             # Display the table
-            df = pd.DataFrame(most_similar_requirements, columns=["Solution", "Most Similar Requirement", "Similarity"])
             st.dataframe(df, use_container_width=True)
         
+    elif st.session_state.selected_option == "Search Similar Solutions from Past Projects":
+        # Search the history of all the generated solutions
+        st.write("### Searching Similar Solutions from Past Projects")
+
+        # Add a short explanation of the selected option
+        with st.expander("What is Searching Similar Solutions from Past Projects?"):
+            st.write("""
+            This option searches all the solutions generated in previous design processes and shows the ones most similar to a given text
+            (by default your design problem), helping you reuse ideas that were already proposed for related problems.
+            """)
+
+        solution_index = get_solution_index()
+        if solution_index is None:
+            st.write("The solutions history is disabled for this app.")
         else:
-            st.write("Choose the option you want for visualization")
+            query = st.text_input("Search for solutions similar to:", value=st.session_state.design_problem)
+            search_category = st.selectbox("Category:", ["All", "Functions", "Behaviors", "Structures"])
+            number_of_results = st.number_input("Number of results:", min_value=1, max_value=100, value=10)
+            if query:
+                query_embedding = pipeline.embed([query])[0]
+                if query_embedding is None:
+                    st.error("The search text embedding could not be generated, please try again.")
+                else:
+                    df = solution_index.search(query_embedding, k=int(number_of_results), category=None if search_category == "All" else search_category)
+                    st.write(f"Searched {len(solution_index)} solutions.")
+                    st.dataframe(df, use_container_width=True)
+
+    else:
+        st.write("Choose the option you want for visualization")
 
 
     # Add a reset button outside the try-except block
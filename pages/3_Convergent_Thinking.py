@@ -3,8 +3,13 @@
 # IMPORT LIBRARIES
 import streamlit as st
 import pandas as pd
+import numpy as np
+from XAI_APP_utils import StreamlitCallbacks, get_embedding_backend, get_solution_index, start_warm_up, show_warm_up_status
+from XAI_APP_pipeline import DesignPipeline
 
 st.set_page_config(layout="wide")  # Set wide layout for the entire app
+start_warm_up()  # Prepare the slow models in the background in case the server was started from this page
+show_warm_up_status()
 
 # DEFINE THE PAGE INITIAL INFORMATION
 
@@ -120,4 +125,45 @@ if st.button("Update Data"):
     st.session_state["convergent_thinking_functions_data"] = edited_functions_data
     st.session_state["convergent_thinking_behaviors_data"] = edited_behaviors_data
     st.session_state["convergent_thinking_structures_data"] = edited_structures_data
-    st.write("The data has been updated")
\ No newline at end of file
+    st.write("The data has been updated")
+
+    # Step 4: Place the new options in the solution space of the Filtering page, only the new options are embedded and they are projected with the already fitted models instead of recalculating the whole space
+    for category, edited_data in [("functions", edited_functions_data), ("behaviors", edited_behaviors_data), ("structures", edited_structures_data)]:
+        model = st.session_state.get(f"{category}_clustering_model")
+        if model is None or f"{category}_umap" not in st.session_state:
+            continue  # The solution space has not been calculated yet, the Filtering page will include the new options when it does
+        if "client" not in st.session_state and get_embedding_backend().requires_client:
+            st.warning("The new options cannot be added to the solution space because the OpenAI client is not initialized.")
+            break
+
+        # Find the options that are not part of the solution space yet
+        known_options = set(st.session_state[f"{category}_list"])
+        new_options = list(dict.fromkeys(
+            option.strip() for option in edited_data["Option"]
+            if isinstance(option, str) and option.strip() and option.strip() not in known_options
+        ))
+        if not new_options:
+            continue
+
+        try:
+            pipeline = DesignPipeline(st.session_state.get("client"), callbacks=StreamlitCallbacks())
+            new_embeddings, new_options, new_umap, new_clusters = pipeline.add_solutions(model, new_options)
+        except Exception as e:
+            st.warning(f"The new {category} could not be added to the solution space: {e}")
+            continue
+        if not new_embeddings:
+            continue
+
+        # Append the new options to the stored solution space
+        st.session_state[f"{category}_umap"] = np.vstack([st.session_state[f"{category}_umap"], new_umap])
+        st.session_state[f"{category}_clusters"] = np.concatenate([st.session_state[f"{category}_clusters"], new_clusters])
+        st.session_state[f"{category}_embeddings"] = list(st.session_state[f"{category}_embeddings"]) + list(new_embeddings)
+        st.session_state[f"{category}_list"] = st.session_state[f"{category}_list"] + new_options
+        st.session_state.pop(f"{category}_similarity_engine", None)  # Rebuilt with the new options in the Filtering page
+        solution_index = get_solution_index()
+        if solution_index is not None:
+            try:
+                solution_index.insert(new_embeddings, new_options, category.capitalize(), st.session_state.get("design_problem"))
+            except Exception as e:
+                st.warning(f"The new {category} could not be added to the solutions history: {e}")
+        st.write(f"{len(new_options)} new {category} added to the solution space")
\ No newline at end of file
@@ -1,18 +1,20 @@
 # GUI FILTERING CODE
 
 # IMPORT LIBRARIES
+import io
 import streamlit as st
-from XAI_APP_utils import answer_generation, extract_probs_information, substitute_tokens, calculate_prob_difference, visualize_scores, clean_tokens, calculate_stopping_condition, calculate_feature_importance
-from transformers import RobertaTokenizer, RobertaForMaskedLM
-from openai import OpenAI
+import pandas as pd
+from XAI_APP_utils import get_masked_lm, get_openai_client, StreamlitCallbacks, MASKED_LM_NAME, answer_generation, extract_probs_information, substitute_tokens, calculate_prob_difference, visualize_scores, clean_tokens, calculate_stopping_condition, ReAgentTrace, FeatureImportanceJob, CONVERGENCE_POLICIES, start_warm_up, show_warm_up_status
+from XAI_APP_pipeline import DesignPipeline, PipelineConfig, build_rating_input
 
 st.set_page_config(layout="wide")  # Set wide layout for the entire app
+start_warm_up()  # Prepare the slow models in the background in case the server was started from this page
+show_warm_up_status()
 
 # API Keys Setup
 if st.session_state.openai_key:
     try:
-        from openai import OpenAI
-        st.session_state.client = OpenAI(api_key=st.session_state.openai_key)  # Store client in session_state to be able to access it from other pages
+        st.session_state.client = get_openai_client(st.session_state.openai_key)  # Store the shared client in session_state to be able to access it from other pages
     except Exception as e:
         st.error(f"Failed to initialize API: {e}")
 else:
@@ -37,6 +39,7 @@ st.markdown("""
    - To see how the LLM interprets your selected option, choose that option from the drop-down list below the table it belongs to.
    - Make sure you select only one option at a time (a function, a behaviour or a structure), if you choose more than one the result will not be displayed.
    - To display the results click on the "Display selection feature importance" button at the bottom of the page. This may take a few minutes, so do not worry and wait for the result to load. Once calculated for the first time, the results will be automatically displayed the rest of the times you select this option. 
+   - You can also click on "Explain all selected options in the background" to calculate the results of every selected option while you keep working, their progress is shown below the button and each result is displayed immediately once it is ready.
 2. **Understand the model's output**:
    - For each selected option you will be able to visualise the perception that the model has of your proposal and what it takes into account when generating this opinion.
    - The **opinion** will be classified as follows:  
@@ -46,25 +49,15 @@ st.markdown("""
             · **Good (4/5):** The solution is well-designed, feasible, and useful, with only minor drawbacks.  
             · **Excellent (5/5):** The solution is highly innovative, fully feasible, and significantly improves the design goal.  
    - To understand **how much importance the model gives to each token** (minimum amount of information that the LLM can capture, usually of similar length to a word) a graph will be shown with the question asked to the model, the darker the tokens are shown, the more attention the LLM is paying to generate that answer.
+3. **Save and replay an explanation**:
+   - Once an explanation is displayed you can download its trace, and upload it at the bottom of the page to display it again without repeating the calculation.
 """)
 
-# CHECK IF ROBERTA IS ALREADY LOADED IN THE SESSION STATE AND DO IT IN CASE IT IS NOT
+# GET THE MASKED LANGUAGE MODEL (ROBERTA BY DEFAULT) SHARED BY ALL THE SESSIONS OF THE SERVER
 
-if "roberta_tokenizer" not in st.session_state or "roberta_model" not in st.session_state:
-    st.write("Loading RoBERTa model and tokenizer. This may take a few seconds...")
-    # Load pre-trained RoBERTa model and tokenizer
-    tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
-    model = RobertaForMaskedLM.from_pretrained('roberta-base')
-    model.eval()  # Set the model to evaluation mode
-
-    # Store the model and tokenizer in session state
-    st.session_state["roberta_tokenizer"] = tokenizer
-    st.session_state["roberta_model"] = model
-    st.write("RoBERTa model and tokenizer loaded successfully!")
-else:
-    st.write("RoBERTa model and tokenizer already loaded.")
-    tokenizer = st.session_state["roberta_tokenizer"]
-    model = st.session_state["roberta_model"]
+# The model is not stored in the session state, all the sessions use the same read-only instance. It is usually already loaded by the background warm-up, otherwise we wait for it
+with st.spinner(f"Loading the {MASKED_LM_NAME} model and tokenizer. This may take a few seconds..."):
+    tokenizer, model = get_masked_lm()
 
 # LOAD THE CHOSEN DATA AND LET THE USERS CHOOSE FOR WHICH ONE THEY WANT TO SEE THE REAGENT FEATURE IMPORTANCE
 
@@ -155,6 +148,29 @@ else:
 
 # DISPLAY THE REAGENT FEATURE IMPORTANCE OF THE FINAL DATA TO ALLOW THE USERS UNDERSTAND WHAT IS THE LLM (CHAT GPT IN THIS CASE) TAKING INTO ACCOUNT TO GENERATE THOSE SOLUTIONS
 
+# This function returns the prefix of the session state keys of the results of an option, the convergence policy is part of it since it changes the results
+def feature_importance_key(type_of_input, selected_item, convergence_policy_name):
+    return f"{type_of_input}_{selected_item}_{convergence_policy_name}"
+
+# This function saves the results of calculate_feature_importance in the session state keys of the selected option
+def store_feature_importance_results(type_of_input, selected_item, convergence_policy_name, results):
+    original_first_token, cleaned_tokens, token_scores_normalized, run_report, trace = results
+    result_key = feature_importance_key(type_of_input, selected_item, convergence_policy_name)
+    st.session_state[f"{result_key}_original_input"] = original_first_token
+    st.session_state[f"{result_key}_cleaned_tokens"] = cleaned_tokens
+    st.session_state[f"{result_key}_token_scores_normalized"] = token_scores_normalized
+    st.session_state[f"{result_key}_run_report"] = run_report
+    st.session_state[f"{result_key}_trace"] = trace
+
+# This function displays the stored results of an option: its score, its token importance and how it was computed
+def show_feature_importance_results(result_key):
+    st.write("Score: ", st.session_state[f"{result_key}_original_input"])
+    html_output = visualize_scores(st.session_state[f"{result_key}_cleaned_tokens"], st.session_state[f"{result_key}_token_scores_normalized"])
+    st.markdown(html_output, unsafe_allow_html=True)
+    report_key = f"{result_key}_run_report"
+    if report_key in st.session_state:
+        st.caption(f"Computed in {st.session_state[report_key]['iterations']} iterations with {st.session_state[report_key]['api_calls']} API calls ({st.session_state[report_key].get('cache_hits', 0)} repeated prompts answered from the cache).")
+
 # We define a condition to run the Reagent method only when one of the selections has been selected
 selections = [selected_function, selected_behavior, selected_structure]
 non_empty_selections = []
@@ -162,6 +178,18 @@ for s in selections:
     if s:
         non_empty_selections.append(s)
 
+# Let the users choose how the convergence of the feature importance calculation is checked
+convergence_policy_labels = {
+    "every": "Check the stopping condition with the LLM after every iteration",
+    "backoff": "Check the stopping condition with the LLM less and less often (fewer API calls)",
+    "ranking": "Stop when the token ranking is stable (no extra API calls)",
+}
+convergence_policy_name = st.selectbox(
+    "Convergence check:",
+    list(CONVERGENCE_POLICIES),
+    format_func=lambda name: convergence_policy_labels.get(name, name),
+)
+
 if st.button("Display selection feature importance"):
         
     if len(non_empty_selections) == 1:
@@ -181,33 +209,123 @@ if st.button("Display selection feature importance"):
 
         role_description = st.session_state["role_description_convergent"]
         design_problem = st.session_state["design_problem"]
-        original_input = f"In one word how good is {selected_item} as a {type_of_input} solution for {design_problem}?"
 
-        # Generate unique keys for session state with the type of input and the selected item
-        input_key = f"{type_of_input}_{selected_item}_original_input"
-        tokens_key = f"{type_of_input}_{selected_item}_cleaned_tokens"
-        scores_key = f"{type_of_input}_{selected_item}_token_scores_normalized"
+        # Generate unique keys for session state with the type of input, the selected item and the convergence policy
+        result_key = feature_importance_key(type_of_input, selected_item, convergence_policy_name)
+        input_key = f"{result_key}_original_input"
+        tokens_key = f"{result_key}_cleaned_tokens"
+        scores_key = f"{result_key}_token_scores_normalized"
+        trace_key = f"{result_key}_trace"
 
         if input_key not in st.session_state or tokens_key not in st.session_state or scores_key not in st.session_state:
             # Calculate feature importance
+            # The perturbations are drawn from a generator seeded with the question, so the result is the same as the one of the background jobs
             with st.spinner("Calculating feature importance, please wait..."):
-                original_first_token, cleaned_tokens, token_scores_normalized = calculate_feature_importance(original_input, role_description, tokenizer, model)
+                pipeline = DesignPipeline(st.session_state.get("client"), PipelineConfig(convergence_policy=convergence_policy_name), StreamlitCallbacks())
+                results = pipeline.explain(selected_item, type_of_input, design_problem, role_description)
             # Save to session state
-            st.session_state[input_key] = original_first_token
-            st.session_state[tokens_key] = cleaned_tokens
-            st.session_state[scores_key] = token_scores_normalized
-
-            st.write("Score: ", st.session_state[input_key])
-            html_output = visualize_scores(st.session_state[tokens_key], st.session_state[scores_key])
-            st.markdown(html_output, unsafe_allow_html=True)
-        else:
-            # Retrieve and display existing data
-            st.write("Score: ", st.session_state[input_key])
-            html_output = visualize_scores(st.session_state[tokens_key], st.session_state[scores_key])
-            st.markdown(html_output, unsafe_allow_html=True)
+            store_feature_importance_results(type_of_input, selected_item, convergence_policy_name, results)
+
+        # Display the new or the existing data
+        show_feature_importance_results(result_key)
+
+        # Let the users download the trace of the calculation to analyze it or display it again later
+        if trace_key in st.session_state:
+            trace_file = io.BytesIO()
+            st.session_state[trace_key].save(trace_file, format="npz")
+            st.download_button("Download explanation trace", trace_file.getvalue(), file_name=f"reagent_trace_{type_of_input}.npz", mime="application/octet-stream")
 
     elif len(non_empty_selections) == 0:
             st.warning("Please select at least one option from the tables, either a function a behavior or a structure, if you do not choose any of them the results cannot be computed.")
 
     else:
-        st.warning("Please select only one of the options from the tables, either a function a behavior or a structure, if you choose more the results cannot be computed.")
\ No newline at end of file
+        st.warning("Please select only one of the options from the tables, either a function a behavior or a structure, if you choose more the results cannot be computed.")
+
+# EXPLAIN ALL THE SELECTED OPTIONS IN THE BACKGROUND
+
+# The jobs run in a worker pool shared by the server, the page only polls them and saves their results in the same session state keys as the single explanations
+if "feature_importance_jobs" not in st.session_state:
+    st.session_state["feature_importance_jobs"] = {}
+feature_importance_jobs = st.session_state["feature_importance_jobs"]
+
+if st.button("Explain all selected options in the background"):
+    if "client" not in st.session_state:
+        st.error("OpenAI client is not initialized. Please provide a valid API key.")
+    else:
+        # Gather every selected function, behavior and structure
+        all_selections = []
+        for type_of_input, data_key in (("functional", "convergent_thinking_functions_data"), ("behavioral", "convergent_thinking_behaviors_data"), ("structural", "convergent_thinking_structures_data")):
+            if data_key in st.session_state:
+                data = st.session_state[data_key]
+                all_selections += [(type_of_input, option) for option in data[data["Selection"] == True]["Option"].tolist()]
+
+        # Queue the options that have not been explained yet (or whose previous job failed)
+        queued = 0
+        for type_of_input, selected_item in all_selections:
+            job_key = feature_importance_key(type_of_input, selected_item, convergence_policy_name)
+            if f"{job_key}_token_scores_normalized" in st.session_state or (job_key in feature_importance_jobs and feature_importance_jobs[job_key][0].status != "failed"):
+                continue
+            original_input = build_rating_input(selected_item, type_of_input, st.session_state["design_problem"])
+            job = FeatureImportanceJob(original_input, st.session_state["role_description_convergent"], st.session_state.client, convergence_policy_name)
+            feature_importance_jobs[job_key] = (job, type_of_input, selected_item, convergence_policy_name)
+            queued += 1
+        if not all_selections:
+            st.warning("There are no selected options, please choose them in the Convergent Thinking page.")
+        elif queued == 0:
+            st.info("All the selected options have already been explained or are being explained.")
+
+# This function displays the progress of the background jobs and saves and displays their results as soon as they finish, it is rerun every 2 seconds while there are jobs running
+# The polling interval is fixed when the page runs, so once all the jobs finish the whole page is rerun to stop polling
+st.session_state["feature_importance_jobs_polling"] = any(not job.future.done() for job, _, _, _ in feature_importance_jobs.values())
+
+@st.fragment(run_every=2 if st.session_state["feature_importance_jobs_polling"] else None)
+def show_feature_importance_jobs():
+    if not feature_importance_jobs:
+        return
+    job_rows = []
+    for job_key, (job, type_of_input, selected_item, job_convergence_policy_name) in list(feature_importance_jobs.items()):
+        status = job.status
+        if status == "done" and f"{job_key}_token_scores_normalized" not in st.session_state:
+            store_feature_importance_results(type_of_input, selected_item, job_convergence_policy_name, job.result())
+        job_rows.append({
+            "Type": type_of_input,
+            "Option": selected_item,
+            "Convergence check": job_convergence_policy_name,
+            "Status": status,
+            "Progress": 1.0 if status == "done" else job.progress,
+            "Error": str(job.future.exception()) if status == "failed" else "",
+        })
+    finished = sum(row["Status"] in ("done", "failed") for row in job_rows)
+    st.progress(finished / len(job_rows), text=f"{finished} of {len(job_rows)} background explanations finished")
+    st.dataframe(pd.DataFrame(job_rows), column_config={"Progress": st.column_config.ProgressColumn("Progress", min_value=0.0, max_value=1.0)})
+    if any(row["Status"] == "failed" for row in job_rows):
+        st.warning("Some explanations failed, click again on the button to retry them.")
+
+    # Display the results of the finished jobs
+    for job_key, (job, type_of_input, selected_item, _) in feature_importance_jobs.items():
+        if f"{job_key}_token_scores_normalized" in st.session_state:
+            with st.expander(f"{type_of_input.capitalize()}: {selected_item}"):
+                show_feature_importance_results(job_key)
+
+    if finished == len(job_rows) and st.session_state["feature_importance_jobs_polling"]:
+        st.session_state["feature_importance_jobs_polling"] = False
+        st.rerun()
+
+show_feature_importance_jobs()
+
+# REPLAY A SAVED EXPLANATION WITHOUT REPEATING THE CALCULATION
+
+st.markdown("### Replay a saved explanation")
+uploaded_trace = st.file_uploader("Upload an explanation trace (.npz or .parquet):", type=["npz", "parquet"])
+if uploaded_trace is not None:
+    try:
+        trace = ReAgentTrace.load(uploaded_trace)
+    except Exception as e:
+        st.error(f"Failed to load the explanation trace: {e}")
+    else:
+        st.write("Input: ", trace.metadata["original_input"])
+        st.write("Score: ", trace.metadata["rating"])
+        html_output = visualize_scores(trace.metadata["cleaned_tokens"], trace.final_scores())
+        st.markdown(html_output, unsafe_allow_html=True)
+        st.caption(f"Computed in {trace.metadata['report']['iterations']} iterations with {trace.metadata['report']['api_calls']} API calls ({trace.metadata['report'].get('cache_hits', 0)} repeated prompts answered from the cache).")
+        st.line_chart(trace.columns["prob_diff"], x_label="Iteration", y_label="Probability difference")
\ No newline at end of file
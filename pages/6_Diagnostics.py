@@ -0,0 +1,39 @@
+# GUI DIAGNOSTICS CODE
+
+# IMPORT LIBRARIES
+import streamlit as st
+import pandas as pd
+from XAI_APP_utils import memory_usage_report, warm_up_status, start_warm_up, show_warm_up_status
+
+st.set_page_config(layout="wide")  # Set wide layout for the entire app
+start_warm_up()  # Prepare the slow models in the background in case the server was started from this page
+show_warm_up_status()
+
+# DEFINE THE PAGE INITIAL INFORMATION
+
+st.title("Diagnostics")
+
+st.markdown("""
+<div style="color: #1E90FF; font-size:16px;">
+    <h5>Important: Server Diagnostics</h5>
+    The <b>Diagnostics</b> page shows the state of the server that runs the app. It is meant for the people deploying the app, designers do not need it to complete the design process.<br>
+</div>
+""", unsafe_allow_html=True)
+
+# DISPLAY THE MEMORY USAGE OF THE SERVER AND OF THE RESOURCES SHARED BETWEEN SESSIONS
+
+st.write("### Memory Usage")
+with st.expander("What is the Memory Usage?"):
+    st.write("""
+    The models and caches of the app are loaded once per server process and shared by all the sessions, so the memory of the server
+    should stay flat when more designers open the app. If the process memory grows with the number of active sessions, some resource is being duplicated.
+    """)
+report = memory_usage_report()
+st.dataframe(pd.DataFrame({"Metric": list(report.keys()), "Value": [round(value, 1) if isinstance(value, float) else value for value in report.values()]}), use_container_width=True)
+
+# DISPLAY THE STATUS OF THE BACKGROUND WARM-UP
+
+st.write("### Background Warm-Up")
+st.dataframe(pd.DataFrame({"Step": list(warm_up_status.keys()), "Status": list(warm_up_status.values())}), use_container_width=True)
+
+st.button("Refresh")  # Rerunning the page updates the values
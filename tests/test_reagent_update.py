@@ -0,0 +1,101 @@
+# REAGENT SCORE UPDATE REGRESSION TEST
+# This test checks that the vectorized ReAgent score update (calculate_logit_update) gives the same logit and normalized scores history as the original per-token loop
+# The masks are drawn with a fixed seed and the LLM probability differences are faked, so no model or API is needed
+# Usage: python -m pytest tests
+
+# IMPORT LIBRARIES
+import math
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+from scipy.special import softmax
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from XAI_APP_utils import calculate_logit_update, draw_perturbation_masks
+
+REPLACE_RATIO = 0.3
+MAX_ITERATIONS = 30
+
+# This function runs the original per-token score update loop and returns its logit and normalized scores history
+def baseline_history(initial_logits, original_token_count, perturbation_masks, prob_diffs, replace_ratio=REPLACE_RATIO):
+    token_scores_logit = list(initial_logits)
+    scaled_probs_diff_vect = [0] * len(token_scores_logit)
+    historical_token_scores_logit = {0: token_scores_logit.copy()}
+    historical_token_scores_normalized = {0: softmax(token_scores_logit).copy()}
+    for i, (replaced_indices, prob_diff) in enumerate(zip(perturbation_masks, prob_diffs)):
+        scaled_diff = prob_diff / original_token_count
+        for idx in range(original_token_count):
+            if idx in replaced_indices:
+                scaled_probs_diff_vect[idx] = scaled_diff
+            elif idx not in replaced_indices:
+                scaled_probs_diff_vect[idx] = -scaled_diff
+        for p in range(original_token_count):
+            logit_term = (scaled_probs_diff_vect[p] + 1) / 2
+            if (1 - logit_term) == 0:
+                epsilon = 1e-10
+                logit_value = math.log((logit_term+epsilon)/(1-logit_term+epsilon))
+                if p in replaced_indices:
+                    logit_value = (1 - replace_ratio) * logit_value
+                elif p not in replaced_indices:
+                    logit_value = replace_ratio * logit_value
+            else:
+                logit_value = math.log(logit_term/(1-logit_term))
+                if p in replaced_indices:
+                    logit_value = (1 - replace_ratio) * logit_value
+                elif p not in replaced_indices:
+                    logit_value = replace_ratio * logit_value
+            token_scores_logit[p] = historical_token_scores_logit[i][p] + logit_value
+        historical_token_scores_logit[i+1] = token_scores_logit.copy()
+        historical_token_scores_normalized[i+1] = softmax(token_scores_logit).copy()
+    return np.array(list(historical_token_scores_logit.values())), np.array(list(historical_token_scores_normalized.values()))
+
+# This function runs the vectorized score update as calculate_feature_importance does and returns its logit and normalized scores history
+def vectorized_history(initial_logits, original_token_count, perturbation_masks, prob_diffs, replace_ratio=REPLACE_RATIO):
+    num_tokens = len(initial_logits)
+    historical_token_scores_logit = np.zeros((len(perturbation_masks) + 1, num_tokens))
+    historical_token_scores_normalized = np.zeros((len(perturbation_masks) + 1, num_tokens))
+    historical_token_scores_logit[0] = initial_logits
+    historical_token_scores_normalized[0] = softmax(initial_logits)
+    updated_mask = np.arange(num_tokens) < original_token_count
+    for i, (replaced_indices, prob_diff) in enumerate(zip(perturbation_masks, prob_diffs)):
+        replaced_mask = np.zeros(num_tokens, dtype=bool)
+        replaced_mask[replaced_indices] = True
+        _, logit_update = calculate_logit_update(prob_diff / original_token_count, replaced_mask, updated_mask, replace_ratio)
+        historical_token_scores_logit[i+1] = historical_token_scores_logit[i] + logit_update
+        historical_token_scores_normalized[i+1] = softmax(historical_token_scores_logit[i+1])
+    return historical_token_scores_logit, historical_token_scores_normalized
+
+# This function draws the initial logits, the masks and the fake probability differences of a run with a fixed seed
+def fake_run(num_tokens, original_token_count, seed):
+    rng = random.Random(seed)
+    initial_logits = [rng.choice([0.0, 0.1]) for _ in range(num_tokens)]
+    perturbation_masks = draw_perturbation_masks(original_token_count, REPLACE_RATIO, MAX_ITERATIONS, rng)
+    prob_diffs = [rng.uniform(-1, 1) for _ in range(MAX_ITERATIONS)]
+    return initial_logits, original_token_count, perturbation_masks, prob_diffs
+
+@pytest.mark.parametrize("num_tokens, original_token_count, seed", [(20, 20, 0), (25, 20, 1), (60, 55, 2), (3, 3, 3)])
+def test_vectorized_update_matches_baseline_loop(num_tokens, original_token_count, seed):
+    run = fake_run(num_tokens, original_token_count, seed)
+    baseline_logit, baseline_normalized = baseline_history(*run)
+    vectorized_logit, vectorized_normalized = vectorized_history(*run)
+    np.testing.assert_array_equal(vectorized_logit, baseline_logit)
+    np.testing.assert_array_equal(vectorized_normalized, baseline_normalized)
+
+# A scaled difference of 1 is corrected with the epsilon for the replaced tokens, in both implementations
+def test_extreme_difference_uses_epsilon():
+    run = ([0.0, 0.1], 1, [[0]], [1.0])
+    baseline_logit, baseline_normalized = baseline_history(*run)
+    vectorized_logit, vectorized_normalized = vectorized_history(*run)
+    np.testing.assert_array_equal(vectorized_logit, baseline_logit)
+    np.testing.assert_array_equal(vectorized_normalized, baseline_normalized)
+
+# A scaled difference of -1 takes the log of 0 for the replaced tokens, both implementations raise the same math domain error
+def test_log_of_zero_raises_math_domain_error():
+    run = ([0.0, 0.1], 1, [[0]], [-1.0])
+    with pytest.raises(ValueError, match="math domain error"):
+        baseline_history(*run)
+    with pytest.raises(ValueError, match="math domain error"):
+        vectorized_history(*run)
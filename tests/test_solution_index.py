@@ -0,0 +1,126 @@
+# SOLUTIONS INDEX RECOVERY TEST
+# These tests check that a SolutionIndex reopened after an interrupted insert or training keeps its vectors, list assignments and metadata in sync
+# Usage: python -m pytest tests
+
+# IMPORT LIBRARIES
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from XAI_APP_utils import SolutionIndex
+
+DIMENSIONS = 8
+
+# This function returns random embeddings and their texts
+def random_solutions(count, seed, prefix="solution"):
+    rng = np.random.default_rng(seed)
+    return list(rng.normal(size=(count, DIMENSIONS))), [f"{prefix} {i}" for i in range(count)]
+
+# This function checks that the search of an index works over all its solutions in every category
+def check_search(index):
+    for category in (None, "Functions"):
+        results = index.search(np.ones(DIMENSIONS), k=len(index), category=category)
+        assert len(results) == len(index)
+
+# A vector (and a partial metadata line) appended without committing the insert is removed when the index is reopened
+def test_reopen_after_partial_append(tmp_path):
+    directory = str(tmp_path / "index")
+    index = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    embeddings, texts = random_solutions(5, 0)
+    assert index.insert(embeddings, texts, "Functions") == 5
+
+    # Simulate a process killed while appending a new solution
+    with open(index.vectors_path, "ab") as file:
+        file.write(np.ones(DIMENSIONS, dtype=np.float32).tobytes())
+    with open(index.metadata_path, "a", encoding="utf-8") as file:
+        file.write('{"text": "orphan", "categ')
+
+    reopened = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    assert len(reopened) == len(reopened.metadata) == 5
+    assert os.path.getsize(reopened.vectors_path) == 5 * DIMENSIONS * 4
+    check_search(reopened)
+
+    # The solution that was not committed can be inserted again and the files stay in sync
+    assert reopened.insert([np.ones(DIMENSIONS)], ["orphan"], "Functions") == 1
+    reopened = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    assert len(reopened) == len(reopened.metadata) == 6
+    assert reopened.metadata[-1]["text"] == "orphan"
+    check_search(reopened)
+
+# Indexes written before the count was stored are reconciled to the shortest of their files
+def test_reopen_index_without_count(tmp_path):
+    directory = str(tmp_path / "index")
+    index = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    embeddings, texts = random_solutions(4, 1)
+    index.insert(embeddings, texts, "Functions")
+    with open(index.info_path, "w") as file:
+        json.dump({"dimensions": DIMENSIONS}, file)
+    with open(index.vectors_path, "ab") as file:
+        file.write(np.ones(DIMENSIONS, dtype=np.float32).tobytes())
+
+    reopened = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    assert len(reopened) == len(reopened.metadata) == 4
+    check_search(reopened)
+
+# A failed insert is rolled back and its solutions can be inserted again
+def test_failed_insert_is_rolled_back(tmp_path, monkeypatch):
+    directory = str(tmp_path / "index")
+    index = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    embeddings, texts = random_solutions(3, 2)
+    index.insert(embeddings, texts, "Functions")
+
+    # Fail after the vectors and the metadata are written, before the insert is committed
+    def failing_write_info(count):
+        raise OSError("No space left on device")
+    monkeypatch.setattr(index, "write_info", failing_write_info)
+    new_embeddings, new_texts = random_solutions(2, 3, "new")
+    try:
+        index.insert(new_embeddings, new_texts, "Functions")
+    except OSError:
+        pass
+    monkeypatch.undo()
+    assert len(index) == len(index.metadata) == 3
+    assert os.path.getsize(index.vectors_path) == 3 * DIMENSIONS * 4
+
+    assert index.insert(new_embeddings, new_texts, "Functions") == 2
+    reopened = SolutionIndex(directory, n_lists=2, min_train_size=1000)
+    assert len(reopened) == len(reopened.metadata) == 5
+    check_search(reopened)
+
+# Centroids whose assignments were not completely written are discarded and trained again
+def test_reopen_after_interrupted_training(tmp_path):
+    directory = str(tmp_path / "index")
+    index = SolutionIndex(directory, n_lists=2, n_probe=2, min_train_size=10)
+    embeddings, texts = random_solutions(12, 4)
+    index.insert(embeddings, texts, "Functions")
+    assert index.centroids is not None and len(index.assignments) == 12
+
+    # Simulate a training interrupted after saving the centroids, with only a prefix of the assignments
+    os.truncate(index.assignments_path, 5 * 4)
+
+    reopened = SolutionIndex(directory, n_lists=2, n_probe=2, min_train_size=10)
+    assert reopened.centroids is not None
+    assert len(reopened.assignments) == len(reopened) == 12
+    np.testing.assert_array_equal(reopened.assignments, reopened.assign(np.asarray(reopened.vectors)))
+
+    # Inserting after the recovery keeps one assignment per vector
+    new_embeddings, new_texts = random_solutions(3, 5, "new")
+    reopened.insert(new_embeddings, new_texts, "Functions")
+    assert len(reopened.assignments) == len(reopened) == len(reopened.metadata) == 15
+    check_search(reopened)
+
+# With too few vectors to train again, the stale centroids are dropped and the search is exact
+def test_stale_centroids_are_dropped(tmp_path):
+    directory = str(tmp_path / "index")
+    index = SolutionIndex(directory, n_lists=2, n_probe=2, min_train_size=10)
+    embeddings, texts = random_solutions(12, 6)
+    index.insert(embeddings, texts, "Functions")
+    os.remove(index.assignments_path)
+
+    reopened = SolutionIndex(directory, n_lists=2, n_probe=2, min_train_size=100)
+    assert reopened.centroids is None and reopened.assignments is None
+    assert not os.path.exists(reopened.centroids_path)
+    check_search(reopened)